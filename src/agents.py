@@ -1,8 +1,13 @@
-from flatland import Flatland
+from flatland import Flatland, FlatlandBatch, SYMBOLS, BORDER
+import flatland
+from trajectory import Trajectory
 from operator import itemgetter
-from copy import copy
+import itertools
 import random
 import math
+import os
+import sys
+import numpy as np
 
 
 class Direction():
@@ -21,6 +26,13 @@ class Direction():
     WWW = (-3, 0)
 
 
+def _sight_offsets(sight):
+    """Split each tuple of directions of a sight table in two offset arrays"""
+    return {facing: (np.array([d[0] for d in directions]),
+                     np.array([d[1] for d in directions]))
+            for facing, directions in sight.items()}
+
+
 class Agent():
     """Superclass for different agents implemented
 
@@ -32,31 +44,113 @@ class Agent():
     environment -- Flatland in which the agent will move
     position -- current position of the agent in the environment
     reward -- current reward of the agent in the environment
-    steps -- lists of positions that agent has traveled in the environment
+    steps -- sequence of positions that agent has traveled in the environment
     facing -- current Direction that the agent is facing
+    record -- True to record the games played in a Trajectory
+    trajectory -- Trajectory of the current game, None if not recorded
+    stop_without_food -- True to end the games once no food is left, which
+    lazy boards do not support
 
     """
 
+    # Games are recorded unless switched off, as during bulk training
+    record = True
+    trajectory = None
+
+    # Games last all their steps unless switched on, since on small boards
+    # the steps after eating all the food are mostly wasted
+    stop_without_food = False
+
+    # Parameters the demo creates the agent with (see make_agent)
+    _demo_parameters = ()
+
+    # Directions of the cells seen (front, left and right) for each facing
+    _sight = {Direction.N: (Direction.N, Direction.W, Direction.E),
+              Direction.E: (Direction.E, Direction.N, Direction.S),
+              Direction.S: (Direction.S, Direction.E, Direction.W),
+              Direction.W: (Direction.W, Direction.S, Direction.N)}
+    _offsets = _sight_offsets(_sight)
+
     def __init__(self):
         self.environment = None
         self.position = None
         self.reward = 0
-        self.steps = []
         self.facing = Direction.N
 
+    def __setstate__(self, state):
+        """Restore a pickled agent, upgrading the game recorded in lists
+
+        Agents pickled before the games were kept in a Trajectory store the
+        steps, neuron_story and output_story lists instead, which are moved
+        into a new Trajectory. The cells in sight, which old agents lack, are
+        translated to the environment again.
+        """
+        steps = state.pop('steps', None)
+        neuron_story = state.pop('neuron_story', None)
+        output_story = state.pop('output_story', None)
+        self.__dict__.update(state)
+        if steps is not None:
+            n_neurons = len(getattr(self, 'neurons', ()))
+            self.trajectory = Trajectory(n_neurons)
+            for position in steps:
+                self.trajectory.add_position(position)
+            for neurons, output in zip(neuron_story or (),
+                                       output_story or ()):
+                self.trajectory.add_decision(np.asarray(neurons), output)
+        if self.environment is not None:
+            self._sight_cells = self.environment.sight(self._offsets)
+
+    @property
+    def steps(self):
+        """Positions visited in the current game, if recorded"""
+        return () if self.trajectory is None else self.trajectory.steps
+
+    @property
+    def neuron_story(self):
+        """Snapshots of the input neurons in the current game, if recorded"""
+        return () if self.trajectory is None else \
+            self.trajectory.neuron_story
+
+    @property
+    def output_story(self):
+        """Outputs chosen in the current game, if recorded"""
+        return () if self.trajectory is None else \
+            self.trajectory.output_story
+
+    def _new_trajectory(self):
+        """Start recording a new game, if recording is switched on"""
+        if self.record:
+            n_neurons = len(getattr(self, 'neurons', ()))
+            self.trajectory = Trajectory(n_neurons)
+        else:
+            self.trajectory = None
+
+    def _record_position(self, position, reward=0):
+        """Record a position visited, if the game is being recorded"""
+        if self.trajectory is not None:
+            self.trajectory.add_position(position, reward)
+
     def new_environment(self, new_env):
         """Sets a new Flatland environment for the agent"""
         # Change the environment
         self.environment = new_env
         # Update the position to the new initial one
         self.position = (new_env.agent_x, new_env.agent_y)
-        # Clear the previous solution trace
-        self.steps = []
+        # Translate the cells in sight to the new environment
+        self._sight_cells = new_env.sight(self._offsets)
+        # Clear the previous solution trace and stories
+        self._new_trajectory()
         # Clear the rewards from the previous solution
         self.reward = 0
-        # Clear the stories
-        self.output_story = []
-        self.neuron_story = []
+
+    def _out_of_food(self):
+        """Return True if the game ends because the board has no food left
+
+        Lazy boards cannot count their food, so they raise a ValueError if
+        stop_without_food is set.
+        """
+        return self.stop_without_food and \
+            self.environment.remaining_food() == 0
 
     def move_to(self, direction):
         """Moves the agent to the cell (x,y) in its actual environment
@@ -90,59 +184,59 @@ class Agent():
         triple with the values of each cell (left, front and right in that
         order) and the direction associated to each of the cells.
         """
+        return tuple((direction, self.look_at(direction))
+                     for direction in self._sight[self.facing])
 
-        front = copy(self.facing)
-        if (front == Direction.N):
-            left = Direction.W
-            right = Direction.E
-        elif (front == Direction.E):
-            left = Direction.N
-            right = Direction.S
-        elif (front == Direction.S):
-            left = Direction.E
-            right = Direction.W
-        elif (front == Direction.W):
-            left = Direction.S
-            right = Direction.N
-        else:
-            print('Error: Invalid direction used = ', front)
+    def policy_movement(self):
+        """Follow the greedy policy to choose next step
+
+        The policy is read from a table indexed by the codes of the front,
+        left and right cells (see _greedy_policy).
+        """
+        codes = self.environment.look(self.position[0], self.position[1],
+                                      self._sight_cells[self.facing])
+        return self._greedy_move(codes)
 
-        surroundings = ((front, self.look_at(front)),
-                        (left, self.look_at(left)),
-                        (right, self.look_at(right)))
+    def _greedy_move(self, codes):
+        """Return the greedy move given the codes of the cells in sight"""
+        front, left, right = codes[:3].tolist()
+        return self._sight[self.facing][_greedy_policy[16*front + 4*left +
+                                                       right]]
 
-        # print('I see {} in front, {} left, and {} right.'.format(
-        #     surroundings[0][1], surroundings[1][1], surroundings[2][1]))
 
-        return surroundings
+def _greedy_option(options):
+    """Return the index of the option taken by the greedy policy
 
-    def policy_movement(self):
-        """Follow the greedy policy to choose next step"""
-        # See the options
-        front, left, right = self.look_around()
-        choices = [front[0], left[0], right[0]]
-        options = [front[1], left[1], right[1]]
-
-        # If there is any food, go for it:
-        if 'F' in options:
-            return choices[options.index('F')]
-        # If there is no food, just go for an empty cell
-        elif '.' in options:
-            return choices[options.index('.')]
-        # If there is no other way...
-        #
-        # Drain the pressure from the swelling,
-        # The sensation's overwhelming,
-        # Give me a long kiss goodnight
-        # and everything will be alright
-        # Tell me that I won't feel a thing
-        # So give me Novacaine.
-        elif 'P' in options:
-            return choices[options.index('P')]
-
-        # And well, this should never happen, but for the sake of completeness
-        else:
-            return choices[options.index('W')]
+    Arguments:
+    options -- symbols of the front, left and right cells, in that order
+    """
+    # If there is any food, go for it:
+    if 'F' in options:
+        return options.index('F')
+    # If there is no food, just go for an empty cell
+    elif '.' in options:
+        return options.index('.')
+    # If there is no other way...
+    #
+    # Drain the pressure from the swelling,
+    # The sensation's overwhelming,
+    # Give me a long kiss goodnight
+    # and everything will be alright
+    # Tell me that I won't feel a thing
+    # So give me Novacaine.
+    elif 'P' in options:
+        return options.index('P')
+
+    # And well, this should never happen, but for the sake of completeness
+    else:
+        return options.index('W')
+
+
+# The greedy policy compiled for every possible perception: the option taken
+# (0 front, 1 left, 2 right) for the codes (front, left, right) of the cells
+# in sight is found at index 16*front + 4*left + right
+_greedy_policy = [_greedy_option([SYMBOLS[code] for code in codes])
+                  for codes in itertools.product(range(4), repeat=3)]
 
 
 class GreedyAgent(Agent):
@@ -166,11 +260,11 @@ class GreedyAgent(Agent):
 
         # Greedy policy is deterministic so there is no point in running more
         # than once.
-        if self.steps != []:
+        if len(self.steps) > 0:
             print('Solution already exists in this agent')
             return self.reward
         else:
-            self.steps.append(self.position)
+            self._record_position(self.position)
 
         # Display initial board
         if output:
@@ -180,10 +274,12 @@ class GreedyAgent(Agent):
 
         # Execution loop
         for i in range(iterations):
+            if self._out_of_food():
+                break
             direction = self.policy_movement()
             pos, end = self.move_to(direction)
             self.position = pos
-            self.steps.append(pos)
+            self._record_position(pos, self._r)
             if output:
                 print('Iteration {}: {}, {}'.format(i, dirs[direction],
                                                     self.reward))
@@ -201,17 +297,17 @@ class SupervisedAgent(Agent):
 
     The neuron array consists of 12 neurons, 4 neurons per cell (front, left,
     right) that can represent the 4 different values of that given cell. There
-    is also a weights dictionary, in that stores the weight associated to each
-    of the pairs (i, j), where i is an output neuron and j is an input
-    neuron. These weights are updated in order for the agent to learn.
+    is also a weights matrix, that stores the weight associated to each of the
+    pairs (i, j), where i is an output neuron and j is an input neuron. These
+    weights are updated in order for the agent to learn.
 
     Public Attributes:
     learning_rate -- The rate at which the agent's weight are modified
     neurons -- Array of binary neurons that represent the surroundings
-    weights -- Dictionary containing each of the (i,j) connections
+    weights -- 3xN matrix containing each of the (i,j) connections
     outputs -- Triple containing the sum of input neurons and direction
-    neuron_story -- Array of snapshots of the neuron net, taken each step
-    output_story -- Array of snapshots of the output net, taken each step
+    neuron_story -- Snapshots of the neuron net, taken each recorded step
+    output_story -- Snapshots of the output net, taken each recorded step
     """
 
     # Dictionaries with the neuron input and output meanings
@@ -256,14 +352,61 @@ class SupervisedAgent(Agent):
                        1: 'Move left',
                        2: 'Move right'}
 
+    # Index of the first neuron of each cell in sight
+    _slots = np.arange(0, 12, 4)
+
+    # Weights array the flat view of the weights was built for
+    _viewed_weights = None
+
+    # Attributes stored in checkpoints along with the weights
+    _hyperparameters = ('learning_rate',)
+    _demo_parameters = (0.01,)
+
     def __init__(self, learning_rate):
         Agent.__init__(self)
         self.learning_rate = learning_rate
-        self.neurons = [0 for _ in range(12)]
-        pairs = [(i, j) for i in range(3) for j in range(12)]
-        self.weights = {(i, j): random.uniform(0, 0.001) for (i, j) in pairs}
-        self.output_story = []
-        self.neuron_story = []
+        self.neurons = np.zeros(12)
+        self.weights = np.array([[random.uniform(0, 0.001) for j in range(12)]
+                                 for i in range(3)])
+
+    def __getstate__(self):
+        """Pickle the agent without the view of its weights"""
+        state = self.__dict__.copy()
+        state.pop('_weight_cells', None)
+        state.pop('_viewed_weights', None)
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled agent, upgrading the old dictionary weights
+
+        The neurons switched on in the previous step, which old agents keep
+        as a whole snapshot, are turned into the indices of those neurons.
+        """
+        weights = state.get('weights')
+        if isinstance(weights, dict):
+            n = len(state['neurons'])
+            state['weights'] = np.array([[weights[i, j] for j in range(n)]
+                                         for i in range(3)])
+            state['neurons'] = np.array(state['neurons'], dtype=float)
+        if '_prev_neurons' in state:
+            prev_neurons = state.pop('_prev_neurons')
+            state['_prev_active'] = None if prev_neurons is None else \
+                np.flatnonzero(prev_neurons).tolist()
+        Agent.__setstate__(self, state)
+
+    def save(self, path):
+        """Save the weights and hyperparameters of the agent in a checkpoint
+
+        The checkpoint is an uncompressed .npz file, so loading it only takes
+        a few milliseconds (see load_agent). It is written to a temporary file
+        first, so an interrupted save never leaves a corrupted checkpoint.
+        """
+        arrays = {name: getattr(self, name) for name in self._hyperparameters}
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, kind=type(self).__name__, weights=self.weights,
+                     **arrays)
+        os.replace(tmp, path)
 
     def print_weights(self):
         """Print the weights values in a readable way"""
@@ -275,23 +418,53 @@ class SupervisedAgent(Agent):
                                            self.weights[i, j]))
         print('---')
 
+    def _weight_view(self):
+        """Return a flat view of the weights to read and write single ones
+
+        The view is rebuilt whenever the weights array is replaced, as when
+        loading an agent or training it in a population.
+        """
+        if self._viewed_weights is not self.weights:
+            self._weight_cells = memoryview(self.weights).cast('B').cast('d')
+            self._viewed_weights = self.weights
+        return self._weight_cells
+
     def _update_neurons(self):
-        """Fill the neuron array with new information of the environment"""
-        # Find all combinations of directions and possible values
-        surroundings = self.look_around()
-        pairs = [(x[1], y) for x in surroundings for y in ['.', 'W', 'F', 'P']]
-        directions = [x[0] for x in surroundings[:3]]
-
-        # Fill the neuron array by comparing each of the values generated
-        for i in range(len(pairs)):
-            direction, value = pairs[i]
-            self.neurons[i] = 1 if (direction == value) else 0
-
-        # Compute inputs
-        self.outputs = [[0, direction] for direction in directions]
-        for i in range(len(self.outputs)):
-            for j in range(len(self.neurons)):
-                self.outputs[i][0] += self.weights[(i, j)] * self.neurons[j]
+        """Fill the neuron array with new information of the environment
+
+        Since a single neuron per cell is switched on, the perception is also
+        kept as the list of the active neurons, which is all the learning
+        rules need to update the weights.
+        """
+        # Read the codes of the cells in sight, which are in the same order
+        # as the neurons of each cell ('.', 'W', 'F', 'P')
+        codes = self.environment.look(self.position[0], self.position[1],
+                                      self._sight_cells[self.facing])
+        directions = self._sight[self.facing]
+        self._codes = codes
+
+        # Fill the neuron array by switching on a neuron per cell
+        active = self._slots + codes
+        self._active = active.tolist()
+        self.neurons.fill(0)
+        self.neurons[active] = 1
+
+        # Compute inputs. A product with the whole neuron array is a single
+        # call, cheaper than gathering the active weights at these widths
+        values = (self.weights @ self.neurons).tolist()
+        self.outputs = [[values[i], directions[i]] for i in range(3)]
+
+    def _add_to_active(self, output, active, value):
+        """Add a value to the weights of an output from some active neurons
+
+        Only the weights of the active neurons are touched, one by one through
+        a flat view of the weights, so the cost of an update grows with the
+        number of cells seen rather than with the number of neurons.
+        """
+        weights = self._weight_view()
+        row = output * len(self.neurons)
+        for j in active:
+            weights[row + j] += value
 
     def _update_weights(self, max_out, choice):
         """Use the policy to update the agent weights
@@ -300,24 +473,23 @@ class SupervisedAgent(Agent):
         max_out -- maximum value of the output array (for normlization)
         choice -- choice taken by the neural network
         """
-        # Learn from the last step taken
-        policy = self.policy_movement()
+        # Learn from the last step taken, reading the greedy policy for the
+        # cells seen when the choice was made
+        policy = self._greedy_move(self._codes)
         correct = 1 if (policy == choice) else 0
         # Compute exponential part of delta_i
         getvalue = itemgetter(0)
         output_values = list(map(getvalue, self.outputs))
         sum_exp = sum([math.exp(n - max_out) for n in output_values])
 
-        # Update each of the weights
+        # Update the weights of the chosen output
         idx = output_values.index(max_out)
-        for j in range(len(self.neurons)):
-            input_n = self.neurons[j]
-            output_n = self.outputs[idx][0]
-            delta = correct - (math.exp(output_n - max_out / sum_exp))
-            self.weights[(idx, j)] += self.learning_rate * input_n * delta
+        output_n = self.outputs[idx][0]
+        delta = correct - (math.exp(output_n - max_out / sum_exp))
+        self._add_to_active(idx, self._active, self.learning_rate * delta)
 
-        self.output_story.append(idx)
-        self.neuron_story.append(copy(self.neurons))
+        if self.trajectory is not None:
+            self.trajectory.add_decision(self.neurons, idx)
 
     def _learn_step(self):
         """Chooses a new movement and learns from it
@@ -352,7 +524,7 @@ class SupervisedAgent(Agent):
                 Direction.S: 'South',
                 Direction.W: 'West'}
 
-        self.steps.append(self.position)
+        self._record_position(self.position)
 
         # Display initial board
         if output:
@@ -362,10 +534,12 @@ class SupervisedAgent(Agent):
 
         # Execution loop
         for i in range(iterations):
+            if self._out_of_food():
+                break
             direction = self._learn_step()
             pos, end = self.move_to(direction)
             self.position = pos
-            self.steps.append(pos)
+            self._record_position(pos, self._r)
             if output:
                 print('Iteration {}: {}, {}'.format(i, dirs[direction],
                                                     self.reward))
@@ -382,65 +556,240 @@ class SupervisedAgent(Agent):
         # Only for inheritance in the QAgents
         pass
 
-    def train(self, episodes, output):
+    def train(self, episodes, output, rows=10, cols=10, steps=50,
+              boards=None, record_every=0, writer=None, checkpoint=None,
+              checkpoint_every=1, monitor=None):
         """Perform several executions in different environments to train the net
 
+        If a ConvergenceMonitor is given, the training stops as soon as it
+        detects convergence, so the rewards returned can be fewer than the
+        episodes requested. The monitor keeps why and when it stopped.
+
         Arguments:
         episodes -- number of episodes (100 executions) to perform
         output -- True if output is desired, false if not
+        rows -- number of rows of the training boards
+        cols -- number of columns of the training boards
+        steps -- number of steps of each execution
+        boards -- iterator of Flatland boards to train in, such as a
+        board_stream or a BoardCorpus stream (random boards if None)
+        record_every -- record only one of every record_every games, or none
+        if 0, since nobody reads the history of bulk training games
+        writer -- TrajectoryWriter to append the recorded games to, if any
+        checkpoint -- path to save the agent to while training, if any
+        checkpoint_every -- save the agent every checkpoint_every episodes
+        monitor -- ConvergenceMonitor to stop the training early, if any
         """
+        record = self.record
         rewards = []
         for i in range(episodes):
             episode_rewards = []
-            for _ in range(100):
-                env = Flatland(10, 10)
+            for game in range(100):
+                if boards is None:
+                    env = Flatland(rows, cols)
+                else:
+                    env = next(boards)
+                self.record = record_every > 0 and game % record_every == 0
                 self.new_environment(env)
-                result = self.learn(50, output)
+                result = self.learn(steps, output)
+                if writer is not None and self.record:
+                    writer.write(self)
                 episode_rewards.append(result)
             avg = sum(episode_rewards)/100
-            print('Episode {}: {}'.format(i, avg))
+            print('Episode {}: {}'.format(i, avg), file=sys.stderr)
             rewards.append(avg)
+            stop = monitor is not None and monitor.update(avg, self.weights)
+            if checkpoint is not None and \
+                    (stop or (i + 1) % checkpoint_every == 0):
+                self.save(checkpoint)
+            if stop:
+                print('Stopped after episode {}: {}'.format(
+                    i, monitor.stop_reason), file=sys.stderr)
+                break
+        self.record = record
         return rewards
 
+    def evaluate(self, games, rows=10, cols=10, steps=50, boards=None,
+                 writer=None, percentiles=(5, 25, 50, 75, 95), batch=10000):
+        """Play games with the weights frozen and return reward statistics
+
+        Nothing is learned and, unless a writer is given, nothing is recorded:
+        the weights are compiled into a PolicyTable and the games are played
+        a batch at a time in a FlatlandBatch. With a writer the games are
+        played one by one to record them. Either way every game starts facing
+        north, ends early if stop_without_food is set and no food is left, and
+        the agent, its learning rate included, is left as it was.
+
+        The result is a dictionary with the number of games, the mean and
+        variance of the rewards, a {percentile: reward} dictionary and the
+        fraction of games that ended running into a wall.
+
+        Arguments:
+        games -- number of games to play
+        rows -- number of rows of the random boards
+        cols -- number of columns of the random boards
+        steps -- number of steps of each game
+        boards -- iterator of Flatland boards to play in, such as a
+        board_stream or a BoardCorpus stream (random boards if None)
+        writer -- TrajectoryWriter to record every game to, if any
+        percentiles -- percentiles of the rewards to report
+        batch -- number of games played at once without a writer
+        """
+        if writer is None:
+            rewards, walls = self._evaluate_batches(games, rows, cols, steps,
+                                                    boards, batch)
+        else:
+            rewards, walls = self._evaluate_games(games, rows, cols, steps,
+                                                  boards, writer)
+        return {'games': games,
+                'mean': float(rewards.mean()),
+                'variance': float(rewards.var()),
+                'percentiles': {p: float(v) for p, v in zip(
+                    percentiles, np.percentile(rewards, percentiles))},
+                'wall_hit_rate': float(walls.mean())}
+
+    def _evaluate_batches(self, games, rows, cols, steps, boards, batch):
+        """Play the games of evaluate() in batches through a PolicyTable"""
+        from policy import PolicyTable
+        policy = PolicyTable.compile(self)
+        rewards = np.zeros(games, dtype=int)
+        walls = np.zeros(games, dtype=bool)
+        for start in range(0, games, batch):
+            size = min(batch, games - start)
+            if boards is None:
+                envs = FlatlandBatch(size, rows, cols)
+            else:
+                envs = FlatlandBatch.from_cells(
+                    [next(boards).original_grid[BORDER:-BORDER,
+                                                BORDER:-BORDER]
+                     for _ in range(size)])
+            rewards[start:start + size] = policy.play_batch(
+                envs, steps, self.stop_without_food)
+            walls[start:start + size] = ~envs.alive
+        return rewards, walls
+
+    def _evaluate_games(self, games, rows, cols, steps, boards, writer):
+        """Play and record the games of evaluate() one by one"""
+        state = self.__dict__.copy()
+        self.record = True
+        self.neurons = np.zeros_like(self.neurons)
+        rewards = np.zeros(games, dtype=int)
+        walls = np.zeros(games, dtype=bool)
+        getvalue = itemgetter(0)
+        for game in range(games):
+            env = Flatland(rows, cols) if boards is None else next(boards)
+            # The base class keeps the learning state of the agent untouched
+            Agent.new_environment(self, env)
+            self.facing = Direction.N
+            self._record_position(self.position)
+            for _ in range(steps):
+                if self._out_of_food():
+                    break
+                self._update_neurons()
+                values = list(map(getvalue, self.outputs))
+                choice = values.index(max(values))
+                self.trajectory.add_decision(self.neurons, choice)
+                pos, end = self.move_to(self.outputs[choice][1])
+                self._record_position(pos, self._r)
+                if end:
+                    walls[game] = True
+                    break
+            writer.write(self)
+            rewards[game] = self.reward
+        self.__dict__.clear()
+        self.__dict__.update(state)
+        return rewards, walls
+
 
 class ReinforcementAgent(SupervisedAgent):
-    """Agent based on reinforcement learning"""
+    """Agent based on reinforcement learning
 
-    def __init__(self, learning_rate, discount, decay):
+    By default the agent learns online, with a TD update of the previous
+    decision in each step. If an ExperienceReplay is given, the transitions
+    are stored in it instead, and the agent learns from random minibatches of
+    them at the interval of the buffer.
+
+    Public Attributes:
+    discount -- discount of the future rewards
+    decay -- decay of the learning rate after each game
+    replay -- ExperienceReplay the agent learns from, None to learn online
+    """
+
+    _hyperparameters = ('learning_rate', 'discount', 'decay')
+    _demo_parameters = (0.005, 0.99, 1)
+
+    # Agents learn online unless given an experience replay
+    replay = None
+
+    def __init__(self, learning_rate, discount, decay, replay=None):
         SupervisedAgent.__init__(self, learning_rate)
         self.discount = discount
         self.decay = decay
+        self.replay = replay
 
     def _update_weights(self, max_q, choice):
         """Evaluate neurons and update the weights of the network"""
 
-        if self._prev_neurons is not None:
-            i = self._prev_out
-            for j in range(len(self.neurons)):
-                input_n = self._prev_neurons[j]
+        if self._prev_active is not None:
+            if self.replay is not None:
+                self._remember(self._active, False)
+            else:
                 delta = self._r + self.discount * max_q - self._prev_q
-                self.weights[(i, j)] += self.learning_rate * input_n * delta
+                self._add_to_active(self._prev_out, self._prev_active,
+                                    self.learning_rate * delta)
 
         getvalue = itemgetter(0)
         output_values = list(map(getvalue, self.outputs))
         self._prev_out = output_values.index(max_q)
         self._prev_r = self._r
-        self._prev_neurons = copy(self.neurons)
+        self._prev_active = self._active
         self._prev_q = max_q
 
-        self.neuron_story.append(copy(self.neurons))
-        self.output_story.append(copy(self._prev_out))
+        if self.trajectory is not None:
+            self.trajectory.add_decision(self.neurons, self._prev_out)
 
         if self._r == -100:
             print("Does this ever happen?")
 
     def _into_wall(self):
         """Force the agent to learn when it runs into a wall"""
-        i = self._prev_out
-        for j in range(len(self.neurons)):
-            input_n = self._prev_neurons[j]
-            delta = -100 + self.discount * (-100) - self._prev_q
-            self.weights[(i, j)] += self.learning_rate * input_n * delta
+        if self.replay is not None:
+            self._remember(None, True)
+            return
+        delta = -100 + self.discount * (-100) - self._prev_q
+        self._add_to_active(self._prev_out, self._prev_active,
+                            self.learning_rate * delta)
+
+    def _remember(self, next_active, terminal):
+        """Store the previous decision in the replay, and learn if it is due
+
+        Arguments:
+        next_active -- active neurons of the decision that followed, if any
+        terminal -- True if the decision ran the agent into a wall
+        """
+        if self.replay.add(self._prev_active, self._prev_out, self._r,
+                           next_active, terminal):
+            self._replay_update()
+
+    def _replay_update(self):
+        """Learn from a minibatch of the replay in a single update
+
+        Each transition gets the same TD update as an online step: the target
+        is the reward plus the discounted value of the best next output, and
+        running into a wall is valued as -100 from then on.
+        """
+        active, actions, rewards, next_active, terminal = \
+            self.replay.sample()
+        actions = actions[:, None]
+        q = self.weights[actions, active].sum(axis=1)
+        next_q = np.where(terminal, -100,
+                          self.weights[:, next_active].sum(axis=2).max(axis=0))
+        delta = rewards + self.discount * next_q - q
+
+        # Add the step of each transition to its active weights only
+        step = np.broadcast_to((self.learning_rate * delta)[:, None],
+                               active.shape)
+        np.add.at(self.weights, (actions, active), step)
 
     def new_environment(self, new_env):
         """Sets a new Flatland environment for the agent"""
@@ -448,87 +797,90 @@ class ReinforcementAgent(SupervisedAgent):
         self.environment = new_env
         # Update the position to the new initial one
         self.position = (new_env.agent_x, new_env.agent_y)
-        # Clear the previous solution trace
-        self.steps = []
+        # Translate the cells in sight to the new environment
+        self._sight_cells = new_env.sight(self._offsets)
+        # Clear the previous solution trace and stories
+        self._new_trajectory()
         # Clear the rewards from the previous solution
         self.reward = 0
         # Clear the state/action variables to maintain integrity
         self._prev_q = None
         self._prev_r = None
         self._prev_out = None
-        self._prev_neurons = None
+        self._prev_active = None
         self._r = 0
         # Decay the learning rate
         self.learning_rate *= self.decay
-        # Clear the stories
-        self.output_story = []
-        self.neuron_story = []
 
 
 class EnhancedAgent(ReinforcementAgent):
+    """Agent based on reinforcement learning that sees three cells away"""
+
+    # Directions of the cells seen for each facing: front, left and right,
+    # followed by the two further cells in front, left and right
+    _sight = {Direction.N: (Direction.N, Direction.W, Direction.E,
+                            Direction.NN, Direction.NNN,
+                            Direction.WW, Direction.WWW,
+                            Direction.EE, Direction.EEE),
+              Direction.E: (Direction.E, Direction.N, Direction.S,
+                            Direction.EE, Direction.EEE,
+                            Direction.NN, Direction.NNN,
+                            Direction.SS, Direction.SSS),
+              Direction.S: (Direction.S, Direction.E, Direction.W,
+                            Direction.SS, Direction.SSS,
+                            Direction.EE, Direction.EEE,
+                            Direction.WW, Direction.WWW),
+              Direction.W: (Direction.W, Direction.S, Direction.N,
+                            Direction.WW, Direction.WWW,
+                            Direction.SS, Direction.SSS,
+                            Direction.NN, Direction.NNN)}
+    _offsets = _sight_offsets(_sight)
+    _slots = np.arange(0, 36, 4)
+
+    def __init__(self, learning_rate, discount, decay, replay=None):
+        ReinforcementAgent.__init__(self, learning_rate, discount, decay,
+                                    replay)
+        self.neurons = np.zeros(36)
+        self.weights = np.array([[random.uniform(0, 0.001) for j in range(36)]
+                                 for i in range(3)])
+
+
+# Class of each kind of agent, by the letter used to choose it
+kinds = {'g': GreedyAgent, 's': SupervisedAgent, 'r': ReinforcementAgent,
+         'e': EnhancedAgent}
+
+# Class of each kind of agent, by its name, as stored in the saved files
+kinds_by_name = {cls.__name__: cls for cls in kinds.values()}
+
+
+def make_agent(kind):
+    """Create a new agent with the default parameters of the demo
+
+    Arguments:
+    kind -- type of the agent: 'g', 's', 'r' or 'e'
+    """
+    cls = kinds[kind]
+    return cls(*cls._demo_parameters)
 
-    def __init__(self, learning_rate, discount, decay):
-        ReinforcementAgent.__init__(self, learning_rate, discount, decay)
-        self.neurons = [0 for _ in range(36)]
-        pairs = [(i, j) for i in range(3) for j in range(36)]
-        self.weights = {(i, j): random.uniform(0, 0.001) for (i, j) in pairs}
 
-    def look_around(self):
-        """Returns the values of the left, front and right cells
+def seed_all(value):
+    """Seed every random generator used by the boards and agents"""
+    random.seed(value)
+    flatland.seed(value)
 
-        This method implements the basic perception of an agent. Returns a
-        triple with the values of each cell (left, front and right in that
-        order) and the direction associated to each of the cells.
-        """
 
-        front = copy(self.facing)
-        if (front == Direction.N):
-            front1 = Direction.NN
-            front2 = Direction.NNN
-            left = Direction.W
-            left1 = Direction.WW
-            left2 = Direction.WWW
-            right = Direction.E
-            right1 = Direction.EE
-            right2 = Direction.EEE
-        elif (front == Direction.E):
-            front1 = Direction.EE
-            front2 = Direction.EEE
-            left = Direction.N
-            left1 = Direction.NN
-            left2 = Direction.NNN
-            right = Direction.S
-            right1 = Direction.SS
-            right2 = Direction.SSS
-        elif (front == Direction.S):
-            front1 = Direction.SS
-            front2 = Direction.SSS
-            left = Direction.E
-            left1 = Direction.EE
-            left2 = Direction.EEE
-            right = Direction.W
-            right1 = Direction.WW
-            right2 = Direction.WWW
-        elif (front == Direction.W):
-            front1 = Direction.WW
-            front2 = Direction.WWW
-            left = Direction.S
-            left1 = Direction.SS
-            left2 = Direction.SSS
-            right = Direction.N
-            right1 = Direction.NN
-            right2 = Direction.NNN
-        else:
-            print('Error: Invalid direction used = ', front)
-
-        surroundings = ((front, self.look_at(front)),
-                        (left, self.look_at(left)),
-                        (right, self.look_at(right)),
-                        (front1, self.look_at(front1)),
-                        (front2, self.look_at(front2)),
-                        (left1, self.look_at(left1)),
-                        (left2, self.look_at(left2)),
-                        (right1, self.look_at(right1)),
-                        (right2, self.look_at(right2)))
-
-        return surroundings
+def load_agent(path):
+    """Load an agent from a checkpoint written by SupervisedAgent.save
+
+    The agent is restored without drawing new random weights, so loading it
+    does not change the random state of the program.
+    """
+    with np.load(path, allow_pickle=False) as checkpoint:
+        cls = kinds_by_name[str(checkpoint['kind'])]
+        agent = cls.__new__(cls)
+        Agent.__init__(agent)
+        agent.weights = checkpoint['weights'].astype(float)
+        agent.neurons = np.zeros(agent.weights.shape[1])
+        for name in cls._hyperparameters:
+            setattr(agent, name, checkpoint[name].item())
+    return agent
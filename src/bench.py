@@ -0,0 +1,184 @@
+from flatland import Flatland
+from agents import GreedyAgent, make_agent, seed_all
+import tracemalloc
+import argparse
+import platform
+import time
+import json
+import sys
+
+
+# Kind of each agent measured by the suite, built with the parameters of the
+# demo (see make_agent)
+_agents = {'greedy': 'g', 'supervised': 's', 'reinforcement': 'r',
+           'enhanced': 'e'}
+_learners = ['supervised', 'reinforcement', 'enhanced']
+
+
+def main(argv=None):
+    """Run the benchmark suite and write the measures as JSON"""
+    parser = argparse.ArgumentParser(
+        description='Measure the speed of the boards and agents. The output '
+        'is JSON, and can be compared against the output of another run.')
+    parser.add_argument('--sizes', default='10x10,20x20,50x50',
+                        help='comma separated board sizes, as ROWSxCOLS')
+    parser.add_argument('--seeds', default='0,1',
+                        help='comma separated seeds to run each measure with')
+    parser.add_argument('--games', type=int, default=200,
+                        help='games played by the per-game measures')
+    parser.add_argument('--episodes', type=int, default=1,
+                        help='episodes of 100 games of the train measures')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the measures to')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(n) for n in size.split('x'))
+             for size in args.sizes.split(',')]
+    seeds = [int(seed) for seed in args.seeds.split(',')]
+    results = run_suite(sizes, seeds, args.games, args.episodes)
+    document = {'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results}
+
+    if args.output is None:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print_comparison(baseline['results'], results)
+
+
+def run_suite(sizes, seeds, games, episodes):
+    """Run every benchmark for each board size and seed
+
+    Arguments:
+    sizes -- list of (rows, cols) board sizes
+    seeds -- list of seeds to run each benchmark with
+    games -- number of games played by the per-game benchmarks
+    episodes -- number of episodes of the train benchmarks
+    """
+    results = []
+    for rows, cols in sizes:
+        for seed in seeds:
+            def record(name, agent, count, unit, fn):
+                results.append(_measure(name, agent, rows, cols, seed, count,
+                                        unit, fn))
+
+            record('board', None, games, 'boards',
+                   lambda: _boards(rows, cols, games))
+            record('run', 'greedy', games, 'steps',
+                   lambda: _games('greedy', rows, cols, games))
+            for agent in _learners:
+                record('perception', agent, games * 50, 'calls',
+                       lambda: _perception(agent, rows, cols, games * 50))
+                record('update', agent, games * 50, 'updates',
+                       lambda: _updates(agent, rows, cols, games * 50))
+                record('learn', agent, games, 'steps',
+                       lambda: _games(agent, rows, cols, games))
+                record('train', agent, episodes, 'episodes',
+                       lambda: _train(agent, rows, cols, episodes))
+    return results
+
+
+def _measure(name, agent, rows, cols, seed, count, unit, fn):
+    """Time a benchmark and measure its peak of allocated memory
+
+    The benchmark function returns the number of units processed, which is
+    used to compute the rate. Time and memory are measured in two separate
+    runs from the same seed, since tracing allocations slows the code down.
+    """
+    seed_all(seed)
+    start = time.perf_counter()
+    units = fn()
+    seconds = time.perf_counter() - start
+
+    seed_all(seed)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'name': name, 'agent': agent, 'rows': rows, 'cols': cols,
+            'seed': seed, 'count': count, 'unit': unit, 'units': units,
+            'seconds': seconds, 'rate': units / seconds,
+            'peak_kb': peak / 1024}
+
+
+def _boards(rows, cols, count):
+    """Generate a number of boards"""
+    for _ in range(count):
+        Flatland(rows, cols)
+    return count
+
+
+def _games(agent, rows, cols, games):
+    """Play a number of 50 steps games and return the steps taken"""
+    agent = make_agent(_agents[agent])
+    steps = 0
+    for _ in range(games):
+        agent.new_environment(Flatland(rows, cols))
+        if isinstance(agent, GreedyAgent):
+            agent.run(50, False)
+        else:
+            agent.learn(50, False)
+        steps += len(agent.steps) - 1
+    return steps
+
+
+def _perception(agent, rows, cols, count):
+    """Build the input neurons of an agent a number of times"""
+    agent = make_agent(_agents[agent])
+    agent.new_environment(Flatland(rows, cols))
+    for _ in range(count):
+        agent._update_neurons()
+    return count
+
+
+def _updates(agent, rows, cols, count):
+    """Apply the learning rule of an agent a number of times"""
+    agent = make_agent(_agents[agent])
+    agent.new_environment(Flatland(rows, cols))
+    agent._update_neurons()
+    max_out, choice = max(agent.outputs, key=lambda output: output[0])
+    for _ in range(count):
+        agent._update_weights(max_out, choice)
+    return count
+
+
+def _train(agent, rows, cols, episodes):
+    """Train an agent for a number of episodes"""
+    agent = make_agent(_agents[agent])
+    agent.train(episodes, False, rows, cols)
+    return episodes
+
+
+def print_comparison(baseline, results):
+    """Print the ratio between the rates of two runs of the suite"""
+    def key(result):
+        return (result['name'], result['agent'], result['rows'],
+                result['cols'], result['seed'])
+
+    previous = {key(result): result for result in baseline}
+    print('{:<12}{:<15}{:>9}{:>6}{:>14}{:>14}{:>9}'.format(
+        'benchmark', 'agent', 'size', 'seed', 'before', 'after', 'ratio'),
+        file=sys.stderr)
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        print('{:<12}{:<15}{:>9}{:>6}{:>14.1f}{:>14.1f}{:>8.2f}x'.format(
+            result['name'], str(result['agent']),
+            '{}x{}'.format(result['rows'], result['cols']), result['seed'],
+            old['rate'], result['rate'], result['rate'] / old['rate']),
+            file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
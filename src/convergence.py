@@ -0,0 +1,78 @@
+from collections import deque
+import numpy as np
+
+
+class ConvergenceMonitor():
+    """Decides when a training has converged and can be stopped early
+
+    The monitor is fed with the average reward of each episode (and the
+    weights of the agent after it), and compares the mean reward of the last
+    window of episodes with the mean of the window before it. Once the
+    improvement between both windows drops below the tolerance, the rewards
+    have plateaued and the training can stop.
+
+    If a weight tolerance is given, the weights must have settled too: the
+    norm of their change along the last window, relative to their norm, must
+    be below that tolerance. This avoids stopping in a temporary plateau while
+    the agent is still learning.
+
+    Public variables:
+    window -- number of episodes of each window compared
+    tolerance -- minimum improvement of the mean reward between windows
+    weight_tolerance -- maximum relative change of the weights, or None
+    min_episodes -- number of episodes to run before checking convergence
+    episodes -- number of episodes seen so far
+    stop_episode -- index of the episode after which the training stopped,
+    None if it did not
+    stop_reason -- description of why the training stopped, None if it did
+    not
+    """
+
+    def __init__(self, window=10, tolerance=0.1, weight_tolerance=None,
+                 min_episodes=0):
+        self.window = window
+        self.tolerance = tolerance
+        self.weight_tolerance = weight_tolerance
+        self.min_episodes = min_episodes
+        self.episodes = 0
+        self.stop_episode = None
+        self.stop_reason = None
+        self._rewards = deque(maxlen=2*window)
+        self._weights = deque(maxlen=window + 1)
+
+    def update(self, reward, weights=None):
+        """Record the result of an episode and return True to stop training
+
+        Arguments:
+        reward -- average reward of the episode
+        weights -- weights of the agent after the episode, if they are checked
+        """
+        self.episodes += 1
+        self._rewards.append(reward)
+        if self.weight_tolerance is not None:
+            self._weights.append(np.array(weights, dtype=float))
+
+        if len(self._rewards) < 2*self.window or \
+                self.episodes < self.min_episodes:
+            return False
+
+        rewards = list(self._rewards)
+        improvement = np.mean(rewards[self.window:]) - \
+            np.mean(rewards[:self.window])
+        if improvement >= self.tolerance:
+            return False
+        reason = 'mean reward improved {:.3f} in the last {} episodes ' \
+            '(tolerance {})'.format(improvement, self.window, self.tolerance)
+
+        if self.weight_tolerance is not None:
+            old = self._weights[0]
+            change = np.linalg.norm(self._weights[-1] - old) / \
+                max(np.linalg.norm(old), 1e-12)
+            if change >= self.weight_tolerance:
+                return False
+            reason += ' and weights changed {:.4f} (tolerance {})'.format(
+                change, self.weight_tolerance)
+
+        self.stop_episode = self.episodes - 1
+        self.stop_reason = reason
+        return True
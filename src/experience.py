@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class ExperienceReplay():
+    """Ring buffer of the transitions experienced by a reinforcement agent
+
+    Each transition is stored as the active input neurons of a decision, the
+    output chosen, the reward obtained, the active neurons of the next
+    decision and whether the move ended the game by running into a wall.
+    Since a single neuron per cell in sight is active, a perception is kept
+    as a short row of neuron indices, and the buffer is preallocated, so
+    adding a transition only copies a few small rows. Once full, the oldest
+    transitions are overwritten.
+
+    Every interval transitions, the agent samples a minibatch of the buffer
+    and learns from all of it in a single vectorized update (see
+    ReinforcementAgent._replay_update).
+
+    Public variables:
+    capacity -- maximum number of transitions stored
+    batch_size -- number of transitions of each minibatch
+    interval -- number of transitions added between two minibatches
+    """
+
+    def __init__(self, capacity=10000, batch_size=32, interval=4, seed=None):
+        """Creates an empty buffer
+
+        Arguments:
+        capacity -- maximum number of transitions stored
+        batch_size -- number of transitions of each minibatch
+        interval -- number of transitions added between two minibatches
+        seed -- seed of the sampling of the minibatches
+        """
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self._rng = np.random.default_rng(seed)
+        self._size = 0
+        self._next = 0
+        self._added = 0
+        # The arrays are allocated with the first transition, once the
+        # number of active neurons is known
+        self._active = None
+
+    def __len__(self):
+        return self._size
+
+    def _allocate(self, n_active):
+        self._active = np.zeros((self.capacity, n_active), dtype=np.int16)
+        self._next_active = np.zeros((self.capacity, n_active),
+                                     dtype=np.int16)
+        self._actions = np.zeros(self.capacity, dtype=np.uint8)
+        self._rewards = np.zeros(self.capacity, dtype=np.int16)
+        self._terminal = np.zeros(self.capacity, dtype=bool)
+
+    def add(self, active, action, reward, next_active, terminal):
+        """Store a transition and return True if a minibatch is due
+
+        The active neurons of the next decision of a terminal transition are
+        never read, and can be None.
+        """
+        if self._active is None:
+            self._allocate(len(active))
+        i = self._next
+        self._active[i] = active
+        if next_active is not None:
+            self._next_active[i] = next_active
+        self._actions[i] = action
+        self._rewards[i] = reward
+        self._terminal[i] = terminal
+        self._next = (i + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+        self._added += 1
+        return self._added % self.interval == 0 and \
+            self._size >= self.batch_size
+
+    def sample(self):
+        """Return a random minibatch of the transitions stored
+
+        The result is a tuple of arrays (active, actions, rewards,
+        next_active, terminal), with a row per transition.
+        """
+        idx = self._rng.integers(0, self._size, self.batch_size)
+        return (self._active[idx], self._actions[idx], self._rewards[idx],
+                self._next_active[idx], self._terminal[idx])
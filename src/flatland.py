@@ -1,5 +1,23 @@
-import random
-from copy import deepcopy
+import numpy as np
+
+
+# Integer codes used by the array-backed boards. The order of the first four
+# matches the order of the perception neurons ('.', 'W', 'F', 'P').
+EMPTY, WALL, FOOD, POISON, AGENT = range(5)
+SYMBOLS = '.WFPA'
+
+# Width of the wall frame around array-backed boards, deep enough for the
+# three-cell sight of the EnhancedAgent.
+BORDER = 3
+
+# Random generator shared by the array-backed boards
+_rng = np.random.default_rng()
+
+
+def seed(value):
+    """Reseed the generator used to create array-backed boards"""
+    global _rng
+    _rng = np.random.default_rng(value)
 
 
 class Flatland():
@@ -19,19 +37,22 @@ class Flatland():
     simulation.
     - 'A': the agent's position in each certain moment.
 
-    Since walls are by default only out of bounds cells, the board should
-    always be accessed through the method provided.
+    The board is stored as an array of one byte codes per cell (see SYMBOLS),
+    framed with BORDER rows and columns of walls. Since walls further away are
+    only out of bounds cells, the board should always be accessed through the
+    methods provided.
 
     Public variables:
     rows -- number of rows in the board
     cols -- number of columns in the board
-    board -- board itself, as a 2D list of chars
+    grid -- board itself, as a 2D array of cell codes including the walls
+    original_grid -- copy of the grid as it was generated
     agent_x -- x coordinate of the agent in that moment
     agent_y -- y coordinate of the agent in that moment
-    food -- list of food coordinates
-    poison -- list of poison coordinates
+    food -- set of the coordinates of the food left
+    poison -- set of the coordinates of the poison left
     eaten_food -- list of already eaten food positions
-    eaten_poison -- list of already poison food positions
+    eaten_poison -- list of already eaten poison positions
     """
 
     # Dictionary storing the reinforcements of each cell. Should not be edited.
@@ -43,48 +64,144 @@ class Flatland():
         'A': 0
     }
 
-    def __init__(self, rows, cols):
-        """Creates a new random Flatland representation of a given size."""
-        self.rows = rows
-        self.cols = cols
-        self.board = [[] for i in range(rows)]
-        self.food = []
-        self.poison = []
-        self.eaten_food = []
-        self.eaten_poison = []
+    # Translation from the cell codes to their chars, used to print boards
+    _to_symbols = bytes.maketrans(bytes(range(len(SYMBOLS))),
+                                  SYMBOLS.encode())
+
+    def __init__(self, rows, cols, rng=None):
+        """Creates a new random Flatland representation of a given size.
+
+        The board is drawn from the given NumPy generator, or from the module
+        generator (see seed()) if none is given.
+        """
+        rng = _rng if rng is None else rng
 
         # Possible value of the cells: empty (.), food (F), poison (P)
-        for row in self.board:
-            for _ in range(cols):
-                # Rules for distribution as stated in the assignment
-                if (random.randint(0, 1)):
-                    # Add food to the board
-                    cell = 'F'
-                    self.food.append((len(row), self.board.index(row)))
-                elif (random.randint(0, 1)):
-                    # Add poison to the board
-                    cell = 'P'
-                    self.poison.append((len(row), self.board.index(row)))
-                else:
-                    # Add an empty cell
-                    cell = '.'
-                row.append(cell)
+        cells = _random_cells((rows, cols), rng)
 
         # Place the agent in a random cell in the board
-        self.agent_y = random.randint(0, rows - 1)
-        self.agent_x = random.randint(0, cols - 1)
-        self.board[self.agent_y][self.agent_x] = 'A'
-        if (self.agent_x, self.agent_y) in self.food:
-            self.food.remove((self.agent_x, self.agent_y))
-        if (self.agent_x, self.agent_y) in self.poison:
-            self.poison.remove((self.agent_x, self.agent_y))
+        agent_y = int(rng.integers(rows))
+        agent_x = int(rng.integers(cols))
+        cells[agent_y, agent_x] = AGENT
+
+        self._load(cells, agent_x, agent_y)
+
+    @classmethod
+    def from_cells(cls, cells):
+        """Creates a Flatland from a 2D array of cell codes
+
+        The array must contain a single AGENT cell with the initial position of
+        the agent, as the boards stored in a corpus (see save_corpus).
+        """
+        board = cls.__new__(cls)
+        agent_y, agent_x = np.unravel_index(np.argmax(cells == AGENT),
+                                            cells.shape)
+        board._load(cells, int(agent_x), int(agent_y))
+        return board
+
+    def _load(self, cells, agent_x, agent_y):
+        """Frames an array of cell codes with walls and sets up the board"""
+        self.rows, self.cols = cells.shape
+        self.agent_x = agent_x
+        self.agent_y = agent_y
+        self.eaten_food = []
+        self.eaten_poison = []
+
+        # Food and poison of the initial board, only counted if requested.
+        # What is left is counted by taking what was eaten, and the sets of
+        # positions are only built if requested, then kept up to date
+        self._n_food = None
+        self._n_poison = None
+        self._food = None
+        self._poison = None
+
+        self.grid = np.full((self.rows + 2*BORDER, self.cols + 2*BORDER),
+                            WALL, dtype=np.uint8)
+        self.grid[BORDER:-BORDER, BORDER:-BORDER] = cells
 
         # Store the copy of the original board
-        self.original_board = deepcopy(self.board)
+        self.original_grid = self.grid.copy()
+
+        self._stride = self.cols + 2*BORDER
+        self._origin = BORDER * self._stride + BORDER
+        self._make_views()
+
+    def _make_views(self):
+        """Create flat views of the grids for fast access to single cells"""
+        self._flat = self.grid.reshape(-1)
+        self._cells = memoryview(self.grid).cast('B')
+        self._original_cells = memoryview(self.original_grid).cast('B')
+
+    def __getstate__(self):
+        """Pickle the board without its views, which cannot be pickled"""
+        state = self.__dict__.copy()
+        for view in ('_flat', '_cells', '_original_cells'):
+            del state[view]
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled board, upgrading the old boards of chars"""
+        if 'board' in state:
+            state = _upgrade_state(state)
+        self.__dict__.update(state)
+        self._make_views()
+
+    @property
+    def food(self):
+        """Set of the coordinates of the food left in the board"""
+        if self._food is None:
+            self._food = _positions(self.grid, FOOD)
+        return self._food
+
+    @property
+    def poison(self):
+        """Set of the coordinates of the poison left in the board"""
+        if self._poison is None:
+            self._poison = _positions(self.grid, POISON)
+        return self._poison
+
+    def remaining_food(self):
+        """Returns the number of food cells left in the board
+
+        The food of the initial board is counted the first time, and only
+        what was eaten afterwards.
+        """
+        if self._n_food is None:
+            self._n_food = int(np.count_nonzero(self.original_grid == FOOD))
+        return self._n_food - len(self.eaten_food)
+
+    def remaining_poison(self):
+        """Returns the number of poison cells left in the board"""
+        if self._n_poison is None:
+            self._n_poison = int(np.count_nonzero(
+                self.original_grid == POISON))
+        return self._n_poison - len(self.eaten_poison)
+
+    def obtainable_reward(self):
+        """Returns the reward still obtainable by eating all the food left"""
+        return self.remaining_food() * self._reinforcements['F']
+
+    def region(self):
+        """Returns the (x, y, cols, rows) rectangle of the board in play
+
+        That is the whole board, the part worth showing or storing. Lazy
+        boards return only the part touched (see LazyFlatland.region).
+        """
+        return 0, 0, self.cols, self.rows
+
+    def original_cells(self, x, y, cols, rows):
+        """Returns the codes of a rectangle of the initial board
+
+        The rectangle starts in the cell (x,y) and must be inside the board.
+        """
+        return self.original_grid[BORDER + y:BORDER + y + rows,
+                                  BORDER + x:BORDER + x + cols]
 
     def to_string(self):
         """Returns a string representation of the Flatland environment."""
-        return '\n'.join([' '.join(row) for row in self.board])
+        cells = self.grid[BORDER:-BORDER, BORDER:-BORDER]
+        return '\n'.join([' '.join(row.tobytes().translate(self._to_symbols)
+                                    .decode()) for row in cells])
 
     def get_cell(self, x, y):
         """Returns the value of the cell (x,y)
@@ -94,7 +211,7 @@ class Flatland():
         list when out of bounds, it is always recommended to use this method.
         """
         if (0 <= x < self.cols and 0 <= y < self.rows):
-            return self.board[y][x]
+            return SYMBOLS[self._cells[y * self._stride + x + self._origin]]
         else:
             return 'W'
 
@@ -107,29 +224,582 @@ class Flatland():
         This method should only be used for graphic representation, not agents.
         """
         if (0 <= x < self.cols and 0 <= y < self.rows):
-            return self.original_board[y][x]
+            return SYMBOLS[self._original_cells[y * self._stride + x +
+                                                self._origin]]
         else:
             return 'W'
 
+    def sight(self, offsets):
+        """Translate tables of (dx, dy) offset arrays to flat grid offsets
+
+        The argument maps any key (usually the facing of an agent) to a pair
+        of arrays of relative coordinates. The returned table maps the same
+        keys to the flat offsets that look() expects.
+        """
+        return {key: dy * self._stride + dx
+                for key, (dx, dy) in offsets.items()}
+
+    def look(self, x, y, offsets):
+        """Returns the codes of the cells seen from (x,y)
+
+        The offsets are taken from a table built with sight(), so that all the
+        cells seen by an agent are read in a single gather. Offsets must not go
+        further than BORDER cells away from the board.
+        """
+        return self._flat[y * self._stride + x + self._origin + offsets]
+
     def move_agent(self, x, y):
         """Moves the agent to the cell (x,y)
 
         The method ensures to maintain the coherence among all attributes in
         the Flatland object when moving the agent, by updating not only the
-        board but the new position of the agent too. It returns the
-        reinforcement of the action just taken.
+        board but the new position of the agent too, and the food and poison
+        left. It returns the reinforcement of the action just taken.
         """
         value = self._reinforcements[self.get_cell(x, y)]
-        # if value == 1:
-        #     self.food.remove((x, y))
-        #     self.eaten_food.append((x, y))
-        # elif value == -4:
-        #     self.poison.remove((x, y))
-        #     self.eaten_food.append((x, y))
         if not value == -100:
-            self.board[self.agent_y][self.agent_x] = '.'
+            stride = self._stride
+            new = y * stride + x + self._origin
+            self._eat(self._cells[new], x, y)
+            self._cells[self.agent_y * stride + self.agent_x +
+                        self._origin] = EMPTY
             self.agent_x = x
             self.agent_y = y
-            self.board[self.agent_y][self.agent_x] = 'A'
+            self._cells[new] = AGENT
 
         return value
+
+    def _eat(self, code, x, y):
+        """Keep track of the food or poison in the cell the agent moves to"""
+        if code == FOOD:
+            self.eaten_food.append((x, y))
+            if self._food is not None:
+                self._food.discard((x, y))
+        elif code == POISON:
+            self.eaten_poison.append((x, y))
+            if self._poison is not None:
+                self._poison.discard((x, y))
+
+
+def _positions(grid, code):
+    """Return the set of (x, y) coordinates of a code in a framed grid"""
+    ys, xs = np.nonzero(grid == code)
+    return set(zip((xs - BORDER).tolist(), (ys - BORDER).tolist()))
+
+
+def _upgrade_state(state):
+    """Convert the state of a pickled board of chars to the array format
+
+    Boards used to keep the cells as lists of chars in board and
+    original_board, along with lists of the food and poison positions, so
+    agents pickled back then hold their last board in that format.
+    """
+    state = dict(state)
+    rows, cols = state['rows'], state['cols']
+    for old, new in (('board', 'grid'), ('original_board', 'original_grid')):
+        grid = np.full((rows + 2*BORDER, cols + 2*BORDER), WALL,
+                       dtype=np.uint8)
+        grid[BORDER:-BORDER, BORDER:-BORDER] = \
+            [[SYMBOLS.index(cell) for cell in row] for row in state.pop(old)]
+        state[new] = grid
+    state.pop('food', None)
+    state.pop('poison', None)
+
+    # Old boards did not record what was eaten, so the food and poison left
+    # are counted as if the current board was the initial one
+    state.setdefault('eaten_food', [])
+    state.setdefault('eaten_poison', [])
+    state['_n_food'] = int(np.count_nonzero(state['grid'] == FOOD)) + \
+        len(state['eaten_food'])
+    state['_n_poison'] = int(np.count_nonzero(state['grid'] == POISON)) + \
+        len(state['eaten_poison'])
+    state['_food'] = None
+    state['_poison'] = None
+    state['_stride'] = cols + 2*BORDER
+    state['_origin'] = BORDER * state['_stride'] + BORDER
+    return state
+
+
+class LazyFlatland():
+    """A Flatland whose cells are only generated when they are read
+
+    The contents of each cell are drawn from a hash of the seed of the board
+    and the coordinates of the cell, following the same distribution as
+    Flatland, so any cell can be generated on its own and always gets the
+    same contents. Only the cells read or changed by the agent are stored,
+    in a dictionary of coordinates to cell codes, so creating a board and
+    playing in it cost the same whatever its size. That allows playing in
+    effectively infinite boards, such as LazyFlatland(10**9, 10**9).
+
+    The board offers the same methods as Flatland, which agents and the
+    Simulation use, but since the cells in sight are not stored in an array,
+    sight() keeps the (dx, dy) offsets and look() reads the cells one by one.
+    The grid arrays of Flatland are only built on request, and should only be
+    used for boards small enough to be stored whole. The Simulation and the
+    trajectory files only use the region of the cells touched (see region).
+
+    Public variables:
+    rows -- number of rows in the board
+    cols -- number of columns in the board
+    seed -- seed of the contents of the cells
+    agent_x -- x coordinate of the agent in that moment
+    agent_y -- y coordinate of the agent in that moment
+    eaten_food -- list of already eaten food positions
+    eaten_poison -- list of already eaten poison positions
+    """
+
+    _reinforcements = Flatland._reinforcements
+    # The food and poison eaten are tracked as in Flatland
+    _eat = Flatland._eat
+
+    def __init__(self, rows, cols, rng=None):
+        """Creates a new lazy Flatland of a given size
+
+        The seed of the cells and the initial position of the agent are drawn
+        from the given NumPy generator, or from the module generator (see
+        seed()) if none is given.
+        """
+        rng = _rng if rng is None else rng
+        self.rows = rows
+        self.cols = cols
+        self.seed = int(rng.integers(2**63))
+        self.agent_x = int(rng.integers(cols))
+        self.agent_y = int(rng.integers(rows))
+        self._start = (self.agent_x, self.agent_y)
+        self.eaten_food = []
+        self.eaten_poison = []
+        # The food and poison left are never known, so there are no sets of
+        # their positions to keep up to date
+        self._food = None
+        self._poison = None
+        # Codes of the cells touched so far, in their current state
+        self._cells = {self._start: AGENT}
+
+    def _original_code(self, x, y):
+        """Return the code of the cell (x,y) in the initial board"""
+        if not (0 <= x < self.cols and 0 <= y < self.rows):
+            return WALL
+        if (x, y) == self._start:
+            return AGENT
+        return _hash_code(self.seed, x, y)
+
+    def _code(self, x, y):
+        """Return the current code of the cell (x,y), storing it if new"""
+        code = self._cells.get((x, y))
+        if code is None:
+            code = self._original_code(x, y)
+            if code != WALL:
+                self._cells[x, y] = code
+        return code
+
+    @property
+    def touched(self):
+        """Number of cells generated and stored so far"""
+        return len(self._cells)
+
+    def region(self):
+        """Returns the (x, y, cols, rows) rectangle of the cells touched
+
+        It is the smallest part of the board holding every cell touched, so
+        it is the part shown by the Simulation and stored in trajectory
+        files, whatever the size of the board.
+        """
+        xs = [x for x, _ in self._cells]
+        ys = [y for _, y in self._cells]
+        return (min(xs), min(ys), max(xs) - min(xs) + 1,
+                max(ys) - min(ys) + 1)
+
+    def original_cells(self, x, y, cols, rows):
+        """Returns the codes of a rectangle of the initial board
+
+        The rectangle starts in the cell (x,y) and must be inside the board.
+        Its cells are generated, but not stored.
+        """
+        ys, xs = np.mgrid[y:y + rows, x:x + cols]
+        cells = _hash_codes(self.seed, xs, ys)
+        start_x, start_y = self._start
+        if x <= start_x < x + cols and y <= start_y < y + rows:
+            cells[start_y - y, start_x - x] = AGENT
+        return cells
+
+    @property
+    def original_grid(self):
+        """Whole initial board framed with walls, as in Flatland
+
+        The whole board is generated, so it should only be used for boards
+        small enough to be stored.
+        """
+        grid = np.full((self.rows + 2*BORDER, self.cols + 2*BORDER), WALL,
+                       dtype=np.uint8)
+        grid[BORDER:-BORDER, BORDER:-BORDER] = \
+            self.original_cells(0, 0, self.cols, self.rows)
+        return grid
+
+    @property
+    def grid(self):
+        """Whole current board framed with walls, as in Flatland"""
+        grid = self.original_grid
+        for (x, y), code in self._cells.items():
+            grid[y + BORDER, x + BORDER] = code
+        return grid
+
+    @property
+    def food(self):
+        """Not available, since it takes generating every cell of the board"""
+        raise _uncountable('food')
+
+    @property
+    def poison(self):
+        """Not available, since it takes generating every cell of the board"""
+        raise _uncountable('poison')
+
+    def remaining_food(self):
+        """Not available, since it takes generating every cell of the board"""
+        raise _uncountable('food')
+
+    def remaining_poison(self):
+        """Not available, since it takes generating every cell of the board"""
+        raise _uncountable('poison')
+
+    def obtainable_reward(self):
+        """Not available, since it takes generating every cell of the board"""
+        raise _uncountable('food')
+
+    def to_string(self):
+        """Returns a string representation of the cells touched so far
+
+        Only the region of the board holding every cell touched is shown
+        (see region), and the cells in it not touched yet are shown as they
+        are.
+        """
+        x0, y0, cols, rows = self.region()
+        return '\n'.join([' '.join(SYMBOLS[self._code(x, y)]
+                                    for x in range(x0, x0 + cols))
+                          for y in range(y0, y0 + rows)])
+
+    def get_cell(self, x, y):
+        """Returns the value of the cell (x,y)
+
+        The return value is a char ('.', 'W', 'F', 'P') representing each of
+        the possible values of a cell.
+        """
+        return SYMBOLS[self._code(x, y)]
+
+    def get_original_cell(self, x, y):
+        """Returns the value of the cell (x,y) in the initial board
+
+        The return value is a char ('.', 'W', 'F', 'P') representing each of
+        the possible values of a cell. This method should only be used for
+        graphic representation, not agents.
+        """
+        return SYMBOLS[self._original_code(x, y)]
+
+    def sight(self, offsets):
+        """Translate tables of (dx, dy) offset arrays for look()
+
+        The offsets are kept as lists of (dx, dy) pairs, since the cells in
+        sight are read one by one.
+        """
+        return {key: list(zip(dx.tolist(), dy.tolist()))
+                for key, (dx, dy) in offsets.items()}
+
+    def look(self, x, y, offsets):
+        """Returns the codes of the cells seen from (x,y)
+
+        The offsets are taken from a table built with sight().
+        """
+        return np.array([self._code(x + dx, y + dy) for dx, dy in offsets],
+                        dtype=np.uint8)
+
+    def move_agent(self, x, y):
+        """Moves the agent to the cell (x,y)
+
+        Works as Flatland.move_agent, returning the reinforcement of the
+        action just taken.
+        """
+        value = self._reinforcements[self.get_cell(x, y)]
+        if not value == -100:
+            self._eat(self._cells[x, y], x, y)
+            self._cells[self.agent_x, self.agent_y] = EMPTY
+            self.agent_x = x
+            self.agent_y = y
+            self._cells[x, y] = AGENT
+
+        return value
+
+
+def _uncountable(what):
+    """Return the error of the queries that cannot be answered lazily"""
+    return ValueError('the {} left in a LazyFlatland cannot be counted '
+                      'without generating the whole board'.format(what))
+
+
+# Constants of the hash of the cells of LazyFlatland (those of SplitMix64)
+_HASH_X = 0x9E3779B97F4A7C15
+_HASH_Y = 0xC2B2AE3D27D4EB4F
+_HASH_M1 = 0xBF58476D1CE4E5B9
+_HASH_M2 = 0x94D049BB133111EB
+_MASK64 = 2**64 - 1
+
+# Cell codes chosen by the two top bits of the hash, as in _random_cells
+_HASH_CODES = (FOOD, FOOD, POISON, EMPTY)
+
+
+def _hash_code(seed, x, y):
+    """Return the code of the cell (x, y) of a LazyFlatland with a seed
+
+    Two bits of a 64-bit hash of the seed and the coordinates choose the
+    code, as two random bits do in _random_cells. The hash is computed with
+    Python integers, faster than NumPy for a single cell.
+    """
+    h = seed ^ (x * _HASH_X & _MASK64)
+    h = (h ^ (h >> 31)) * _HASH_M1 & _MASK64
+    h ^= y * _HASH_Y & _MASK64
+    h = (h ^ (h >> 30)) * _HASH_M1 & _MASK64
+    h = (h ^ (h >> 27)) * _HASH_M2 & _MASK64
+    h ^= h >> 31
+    return _HASH_CODES[h >> 62]
+
+
+def _hash_codes(seed, x, y):
+    """Return the codes of the cells of arrays of coordinates, as _hash_code
+
+    Coordinates must not be negative.
+    """
+    with np.errstate(over='ignore'):
+        h = np.uint64(seed) ^ (x.astype(np.uint64) * np.uint64(_HASH_X))
+        h = (h ^ (h >> np.uint64(31))) * np.uint64(_HASH_M1)
+        h ^= y.astype(np.uint64) * np.uint64(_HASH_Y)
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(_HASH_M1)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(_HASH_M2)
+        h ^= h >> np.uint64(31)
+    return np.array(_HASH_CODES, dtype=np.uint8)[h >> np.uint64(62)]
+
+
+def _random_cells(shape, rng=None):
+    """Return an array of random cell codes following the Flatland rules
+
+    Each cell gets food with a 50% chance, and poison with a 50% chance if it
+    did not get any food, so a single draw of two random bits is enough.
+    """
+    rng = _rng if rng is None else rng
+    codes = np.array([FOOD, FOOD, POISON, EMPTY], dtype=np.uint8)
+    return codes[rng.integers(0, 4, shape, dtype=np.uint8)]
+
+
+def board_stream(rows, cols, seed=None, lazy=False):
+    """Yields an endless stream of random boards drawn from a given seed
+
+    With lazy set, the boards are LazyFlatland boards.
+    """
+    rng = np.random.default_rng(seed)
+    kind = LazyFlatland if lazy else Flatland
+    while True:
+        yield kind(rows, cols, rng)
+
+
+def save_corpus(path, count, rows, cols, seed=None, chunk=4096):
+    """Generates a corpus of random boards and stores it in a .npy file
+
+    The file holds a (count, rows, cols) array of cell codes, one byte per
+    cell, in which the initial position of each agent is marked with an AGENT
+    cell. The boards are generated in chunks, so corpora larger than the
+    memory available can be created too.
+    """
+    rng = np.random.default_rng(seed)
+    corpus = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                       shape=(count, rows, cols))
+    for start in range(0, count, chunk):
+        size = min(chunk, count - start)
+        cells = _random_cells((size, rows, cols), rng)
+        agent_y = rng.integers(0, rows, size)
+        agent_x = rng.integers(0, cols, size)
+        cells[np.arange(size), agent_y, agent_x] = AGENT
+        corpus[start:start + size] = cells
+    corpus.flush()
+    del corpus
+
+
+class BoardCorpus():
+    """A corpus of boards stored by save_corpus, memory-mapped from disk
+
+    Boards are only read from disk when they are requested, and each request
+    returns a new Flatland, so the same corpus can be used again and again to
+    train and evaluate different agents in the very same boards.
+
+    Public variables:
+    cells -- read-only (count, rows, cols) array with the boards
+    rows -- number of rows in each board
+    cols -- number of columns in each board
+    """
+
+    def __init__(self, path):
+        """Memory-maps the corpus stored in a given path."""
+        self.cells = np.load(path, mmap_mode='r')
+        _, self.rows, self.cols = self.cells.shape
+
+    def __len__(self):
+        return self.cells.shape[0]
+
+    def __getitem__(self, i):
+        """Returns a new Flatland with the i-th board of the corpus."""
+        return Flatland.from_cells(self.cells[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def stream(self, start=0):
+        """Yields the boards endlessly, starting again when reaching the end"""
+        i = start
+        while True:
+            yield self[i % len(self)]
+            i += 1
+
+
+class FlatlandBatch():
+    """A batch of random Flatland boards that are stepped all at once
+
+    The boards follow the same distribution and reward table as Flatland, but
+    they are stored in a single integer array so that a whole batch of agents
+    can be moved with a handful of array operations. Each board is framed with
+    BORDER rows and columns of walls, so any cell an agent can see is always a
+    valid index of the array.
+
+    Once an agent runs into a wall its board is frozen: it stays in place and
+    any further movement is ignored and rewarded with 0.
+
+    Public variables:
+    size -- number of boards in the batch
+    rows -- number of rows in each board
+    cols -- number of columns in each board
+    grid -- array of cell codes, of shape (size, rows + 2B, cols + 2B)
+    original_grid -- copy of the grid as it was generated
+    agent_x -- array with the x coordinate of each agent
+    agent_y -- array with the y coordinate of each agent
+    alive -- boolean array, False for the agents that ran into a wall
+    food_left -- array with the number of food cells left in each board
+    poison_left -- array with the number of poison cells left in each board
+    """
+
+    # Reinforcement of each cell code, taken from the Flatland table
+    _rewards = np.array([Flatland._reinforcements[s] for s in SYMBOLS])
+
+    def __init__(self, size, rows, cols, rng=None):
+        """Creates a batch of random Flatland boards of a given size.
+
+        The boards are drawn from the given NumPy generator, or from the
+        module generator (see seed()) if none is given.
+        """
+        rng = _rng if rng is None else rng
+
+        # Same distribution as Flatland
+        cells = _random_cells((size, rows, cols), rng)
+
+        # Place each agent in a random cell of its board
+        agent_x = rng.integers(0, cols, size)
+        agent_y = rng.integers(0, rows, size)
+        cells[np.arange(size), agent_y, agent_x] = AGENT
+
+        self._load(cells, agent_x, agent_y)
+
+    @classmethod
+    def from_cells(cls, cells):
+        """Creates a batch from a 3D array of cell codes, a board per row
+
+        Each board must contain a single AGENT cell with the initial position
+        of its agent, as the boards stored in a corpus (see save_corpus).
+        """
+        batch = cls.__new__(cls)
+        cells = np.array(cells, dtype=np.uint8)
+        size, _, cols = cells.shape
+        agent_y, agent_x = np.divmod(
+            (cells == AGENT).reshape(size, -1).argmax(axis=1), cols)
+        batch._load(cells, agent_x, agent_y)
+        return batch
+
+    def _load(self, cells, agent_x, agent_y):
+        """Frames an array of boards with walls and sets up the batch"""
+        self.size, self.rows, self.cols = cells.shape
+        self.agent_x = agent_x
+        self.agent_y = agent_y
+        self._boards = np.arange(self.size)
+
+        # Frame the boards with walls
+        self.grid = np.full((self.size, self.rows + 2*BORDER,
+                             self.cols + 2*BORDER), WALL, dtype=np.uint8)
+        self.grid[:, BORDER:-BORDER, BORDER:-BORDER] = cells
+        self.original_grid = self.grid.copy()
+        self.alive = np.ones(self.size, dtype=bool)
+        self.food_left = np.count_nonzero(cells == FOOD, axis=(1, 2))
+        self.poison_left = np.count_nonzero(cells == POISON, axis=(1, 2))
+
+        # Flat view of the grid and flat index of the cell (0, 0) of each
+        # board, to read and write cells with a single gather or scatter
+        self._flat = self.grid.reshape(-1)
+        self._stride = self.cols + 2*BORDER
+        self._origin = self._boards * self.grid[0].size + \
+            BORDER * self._stride + BORDER
+
+    def to_string(self, k):
+        """Returns a string representation of the k-th board."""
+        cells = self.grid[k, BORDER:-BORDER, BORDER:-BORDER]
+        return '\n'.join([' '.join(SYMBOLS[c] for c in row) for row in cells])
+
+    def get_cells(self, x, y):
+        """Returns the codes of the cells (x[k], y[k]) of each board k
+
+        Both coordinate arrays must have the batch size as first dimension;
+        any trailing dimension is used to query several cells per board at
+        once. Cells out of bounds are always reported as walls.
+        """
+        x = np.clip(x, -BORDER, self.cols + BORDER - 1) + BORDER
+        y = np.clip(y, -BORDER, self.rows + BORDER - 1) + BORDER
+        boards = self._boards.reshape((-1,) + (1,) * (np.ndim(x) - 1))
+        return self.grid[boards, y, x]
+
+    def sight(self, offsets):
+        """Translate tables of (dx, dy) offset arrays to flat grid offsets
+
+        Works as Flatland.sight, but the offsets returned are valid for every
+        board of the batch.
+        """
+        return {key: dy * self._stride + dx
+                for key, (dx, dy) in offsets.items()}
+
+    def look(self, offsets):
+        """Returns the codes of the cells seen by each agent
+
+        The offsets are a (size, n) array with the flat offsets (see sight)
+        of the n cells seen by each agent, and the result has the same shape.
+        Offsets must not go further than BORDER cells away from the board.
+        """
+        agents = self._origin + self.agent_y * self._stride + self.agent_x
+        return self._flat[agents[:, None] + offsets]
+
+    def move_agents(self, x, y):
+        """Moves each agent k to the cell (x[k], y[k]) of its board
+
+        The method returns an array with the reinforcement obtained by each
+        agent. Agents running into a wall stay in place and are marked as not
+        alive, so that their boards are not modified anymore. The cells must
+        not be further than BORDER cells away from the board, as any cell next
+        to an agent is. The food and poison left in each board are updated
+        too.
+        """
+        cells = self._origin + y * self._stride + x
+        codes = self._flat[cells]
+        rewards = np.where(self.alive, self._rewards[codes], 0)
+        self.alive &= codes != WALL
+        self.food_left -= self.alive & (codes == FOOD)
+        self.poison_left -= self.alive & (codes == POISON)
+
+        moving = self._boards[self.alive]
+        old = self._origin[moving] + self.agent_y[moving] * self._stride + \
+            self.agent_x[moving]
+        self._flat[old] = EMPTY
+        self.agent_x[moving] = x[moving]
+        self.agent_y[moving] = y[moving]
+        self._flat[cells[moving]] = AGENT
+
+        return rewards
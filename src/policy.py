@@ -0,0 +1,162 @@
+from flatland import FlatlandBatch
+from agents import Agent, Direction, kinds_by_name
+import itertools
+import numpy as np
+
+
+# Order of the facings in the tables of the batch runner
+_facings = (Direction.N, Direction.E, Direction.S, Direction.W)
+
+
+class PolicyTable():
+    """Frozen policy of a trained agent, compiled into a lookup table
+
+    The perception of an agent is the code of each cell in sight, so with its
+    weights frozen there is a fixed output for each of the 4^C possible
+    perceptions of C cells: 64 for the 3 cells of SupervisedAgent and
+    ReinforcementAgent, 262144 for the 9 cells of EnhancedAgent. The table
+    stores that output (0 forwards, 1 left, 2 right) for every perception,
+    indexed by the codes of the cells read as a base 4 number, the first cell
+    in sight being the most significant digit.
+
+    Public variables:
+    table -- array with the output chosen for each perception
+    kind -- class of the agent compiled, which defines the cells in sight
+    """
+
+    def __init__(self, table, kind):
+        """Creates a policy from its table and the class of its agent"""
+        self.table = table
+        self.kind = kind
+        self._powers = 4 ** np.arange(len(kind._slots))[::-1]
+
+    @classmethod
+    def compile(cls, agent):
+        """Compile the current weights of a learning agent into a table
+
+        The outputs of every perception are computed at once, adding for each
+        cell in sight the weights of the neuron its code switches on, and the
+        best one is taken as the agent does (the first one on ties).
+        """
+        slots = agent._slots
+        codes = np.array(list(itertools.product(range(4),
+                                                repeat=len(slots))))
+        values = np.zeros((len(codes), 3))
+        for c, slot in enumerate(slots):
+            values += agent.weights[:, slot + codes[:, c]].T
+        table = values.argmax(axis=1).astype(np.uint8)
+        return cls(table, type(agent))
+
+    def save(self, path):
+        """Save the table in an uncompressed .npz file"""
+        with open(path, 'wb') as f:
+            np.savez(f, table=self.table, kind=self.kind.__name__)
+
+    @classmethod
+    def load(cls, path):
+        """Load a table saved with save()"""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['table'], kinds_by_name[str(data['kind'])])
+
+    def perception(self, codes):
+        """Returns the index in the table of the codes of the cells in sight"""
+        return int(codes @ self._powers)
+
+    def agent(self):
+        """Returns a new TableAgent that follows this policy"""
+        return TableAgent(self)
+
+    def play(self, games, rows=10, cols=10, steps=50, rng=None):
+        """Play a number of games at once and return the reward of each one
+
+        The games are played in a FlatlandBatch of random boards, drawn from
+        the given NumPy generator or from the module generator of flatland if
+        none is given (see play_batch, which takes any batch).
+        """
+        batch = FlatlandBatch(games, rows, cols, rng)
+        return self.play_batch(batch, steps)
+
+    def play_batch(self, batch, steps=50, stop_without_food=False):
+        """Play a game in each board of a batch and return their rewards
+
+        Each step of all the games is a gather of the cells in sight, a table
+        read and a move. Every agent starts facing north, and the agents that
+        ran into a wall are the ones no longer alive in the batch. With
+        stop_without_food, the agents of the boards with no food left stay in
+        place, as Agent.stop_without_food ends their games.
+        """
+        sight = batch.sight(self.kind._offsets)
+        sight = np.array([sight[f] for f in _facings])
+        moves_x = np.array([self.kind._offsets[f][0][:3] for f in _facings])
+        moves_y = np.array([self.kind._offsets[f][1][:3] for f in _facings])
+        turns = np.array([[_facings.index(d) for d in self.kind._sight[f][:3]]
+                          for f in _facings])
+
+        facing = np.zeros(batch.size, dtype=int)
+        rewards = np.zeros(batch.size, dtype=int)
+        for _ in range(steps):
+            out = self.table[batch.look(sight[facing]) @ self._powers]
+            x = batch.agent_x + moves_x[facing, out]
+            y = batch.agent_y + moves_y[facing, out]
+            if stop_without_food:
+                # Moving to the own cell leaves the board as it is
+                done = batch.food_left == 0
+                x = np.where(done, batch.agent_x, x)
+                y = np.where(done, batch.agent_y, y)
+            facing = turns[facing, out]
+            rewards += batch.move_agents(x, y)
+            playing = batch.alive
+            if stop_without_food:
+                playing = playing & (batch.food_left > 0)
+            if not playing.any():
+                break
+        return rewards
+
+
+class TableAgent(Agent):
+    """Agent that plays a frozen policy compiled into a PolicyTable
+
+    It sees the same cells as the agent the policy was compiled from, and
+    each of its steps is a single read of the table. Like the GreedyAgent, it
+    does not learn, so it plays with run().
+    """
+
+    def __init__(self, policy):
+        Agent.__init__(self)
+        self.policy = policy
+        self._sight = policy.kind._sight
+        self._offsets = policy.kind._offsets
+
+    def run(self, iterations, output):
+        """Run a complete simulation of a given number of steps
+
+        Arguments:
+        iterations -- number of iterations to perform
+        output -- True if output is desired, false if not
+        """
+        self._record_position(self.position)
+
+        if output:
+            print('The initial board is:\n')
+            print(self.environment.to_string())
+            print()
+
+        # Execution loop
+        table = self.policy.table
+        for i in range(iterations):
+            if self._out_of_food():
+                break
+            codes = self.environment.look(self.position[0], self.position[1],
+                                          self._sight_cells[self.facing])
+            choice = table[self.policy.perception(codes)]
+            pos, end = self.move_to(self._sight[self.facing][choice])
+            self._record_position(pos, self._r)
+            if output:
+                print('Iteration {}: {}'.format(i, self.reward))
+            if end:
+                return self.reward
+
+        if output:
+            print('End of solution, final reward: {}\n'.format(self.reward))
+            print(self.environment.to_string())
+        return self.reward
@@ -0,0 +1,175 @@
+from flatland import FlatlandBatch
+from agents import Direction, ReinforcementAgent
+import numpy as np
+import sys
+
+
+# Order of the facings in the tables of the population
+_facings = (Direction.N, Direction.E, Direction.S, Direction.W)
+
+
+class PopulationTrainer():
+    """Trains a population of independent reinforcement agents at once
+
+    The weights of the K agents are stacked in a single (K, 3, N) array, and
+    each tick of the training moves every agent one step on its own board of a
+    FlatlandBatch. Each agent follows exactly the same learning rule as
+    ReinforcementAgent.learn, but the perception, the choice of the movement
+    and the weight updates of the whole population are done with a handful of
+    array operations, so training a hundred agents costs about the same as
+    training a few of them one after the other.
+
+    The hyperparameters can be given either as a single value shared by all
+    the agents or as a sequence with a value per agent.
+
+    Public variables:
+    size -- number of agents in the population
+    agents -- list of the agents trained, whose weights are views of the
+    stacked array and are therefore always up to date
+    weights -- (K, 3, N) array with the weights of every agent
+    learning_rate -- array with the current learning rate of each agent
+    discount -- array with the discount of each agent
+    decay -- array with the decay of the learning rate of each agent
+    """
+
+    def __init__(self, learning_rate, discount, decay, size=None,
+                 kind=ReinforcementAgent):
+        """Creates a population of agents with the given hyperparameters
+
+        Arguments:
+        learning_rate -- learning rate, or sequence with one per agent
+        discount -- discount factor, or sequence with one per agent
+        decay -- decay of the learning rate, or sequence with one per agent
+        size -- number of agents, if every hyperparameter is a single value
+        kind -- class of the agents: ReinforcementAgent or EnhancedAgent
+        """
+        learning_rate, discount, decay = np.broadcast_arrays(
+            np.asarray(learning_rate, dtype=float),
+            np.asarray(discount, dtype=float),
+            np.asarray(decay, dtype=float))
+        if learning_rate.ndim == 0:
+            shape = (1 if size is None else size,)
+            learning_rate, discount, decay = (np.broadcast_to(a, shape)
+                                              for a in (learning_rate,
+                                                        discount, decay))
+        self.size = len(learning_rate)
+        self.learning_rate = learning_rate.copy()
+        self.discount = discount.copy()
+        self.decay = decay.copy()
+
+        # Create the agents as usual, so their initial weights are drawn
+        # like those of agents trained on their own, and stack their weights
+        self.agents = [kind(*params) for params in
+                       zip(self.learning_rate.tolist(), self.discount.tolist(),
+                           self.decay.tolist())]
+        self.weights = np.stack([agent.weights for agent in self.agents])
+        for k, agent in enumerate(self.agents):
+            agent.weights = self.weights[k]
+        # Flat view of the weights and flat index of the row of each output
+        # of each agent, to gather and scatter weights in a single operation
+        n = self.weights.shape[2]
+        self._flat = self.weights.reshape(-1)
+        self._rows = np.arange(self.size)[:, None] * 3 * n + np.arange(3) * n
+
+        # Cells in sight for each facing, the first three being the moves
+        self._offsets = {i: kind._offsets[f] for i, f in enumerate(_facings)}
+        self._dx = np.array([self._offsets[i][0] for i in range(4)])
+        self._dy = np.array([self._offsets[i][1] for i in range(4)])
+        self._turns = np.array([[_facings.index(d) for d in kind._sight[f][:3]]
+                                for f in _facings])
+        self._slots = kind._slots
+        # Agents keep facing their last direction from one game to the next
+        self._facing = np.zeros(self.size, dtype=int)
+
+    def learn(self, rows=10, cols=10, steps=50, rng=None, batch=None):
+        """Play a game in a new board with each agent, learning in each step
+
+        The boards are drawn from the given NumPy generator, or from the
+        module generator of flatland if none is given, unless a FlatlandBatch
+        with a board per agent is given, as one made with from_cells from a
+        corpus. Returns an array with the reward obtained by each agent.
+        """
+        if batch is None:
+            batch = FlatlandBatch(self.size, rows, cols, rng)
+        elif batch.size != self.size:
+            raise ValueError('the batch has {} boards for {} agents'.format(
+                batch.size, self.size))
+        sight = batch.sight(self._offsets)
+        sight = np.array([sight[i] for i in range(4)])
+        self.learning_rate *= self.decay
+        rewards = np.zeros(self.size, dtype=int)
+        prev_r = np.zeros(self.size)
+        prev_q = None
+        prev_out = None
+        prev_active = None
+
+        for _ in range(steps):
+            # Look around: index of the neuron switched on by each cell seen
+            active = self._slots + batch.look(sight[self._facing])
+
+            # Since the neurons are binary, the output of each agent is the
+            # sum of the weights of its active neurons
+            index = self._rows[:, :, None] + active[:, None]
+            q = self._flat[index].sum(axis=2)
+            out = q.argmax(axis=1)
+            max_q = q.max(axis=1)
+
+            # Update the weights of the previous decision of the live agents
+            alive = batch.alive.copy()
+            if prev_q is not None:
+                delta = prev_r + self.discount * max_q - prev_q
+                self._update(alive, prev_out, prev_active,
+                             self.learning_rate * delta)
+
+            # Move each agent in the direction chosen
+            facing = self._turns[self._facing, out]
+            move_x = batch.agent_x + self._dx[facing, 0]
+            move_y = batch.agent_y + self._dy[facing, 0]
+            reward = batch.move_agents(move_x, move_y)
+            self._facing[alive] = facing[alive]
+            rewards += reward
+
+            # Agents that ran into a wall learn from it and stop
+            crashed = alive & ~batch.alive
+            if crashed.any():
+                delta = -100 + self.discount * (-100) - max_q
+                self._update(crashed, out, active, self.learning_rate * delta)
+                if not batch.alive.any():
+                    break
+
+            prev_r = reward
+            prev_q = max_q
+            prev_out = out
+            prev_active = active
+
+        for k, agent in enumerate(self.agents):
+            agent.learning_rate = float(self.learning_rate[k])
+        return rewards
+
+    def _update(self, mask, out, active, step):
+        """Add a step to the weights of the active neurons of some agents
+
+        Every agent is updated in a single scatter, with a null step for the
+        agents out of the mask.
+        """
+        rows = self._rows[np.arange(self.size), out]
+        self._flat[rows[:, None] + active] += np.where(mask, step, 0)[:, None]
+
+    def train(self, episodes, rows=10, cols=10, steps=50, rng=None):
+        """Train every agent for several episodes of 100 games
+
+        The boards are drawn from the given NumPy generator, or from the
+        module generator of flatland if none is given. Returns a (K, episodes)
+        array with the average reward of each agent in each episode: row k is
+        the curve ReinforcementAgent.train would return for the k-th agent.
+        """
+        rewards = np.empty((self.size, episodes))
+        for i in range(episodes):
+            episode_rewards = np.zeros(self.size)
+            for _ in range(100):
+                episode_rewards += self.learn(rows, cols, steps, rng)
+            rewards[:, i] = episode_rewards / 100
+            print('Episode {}: best {}, mean {}'.format(
+                i, rewards[:, i].max(), rewards[:, i].mean()),
+                file=sys.stderr)
+        return rewards
@@ -1,11 +1,338 @@
-from flatland import Flatland
-from agents import GreedyAgent, SupervisedAgent, ReinforcementAgent, \
-    EnhancedAgent
-from window import Simulation
-import matplotlib.pyplot as plt
+from flatland import Flatland, BoardCorpus, save_corpus, board_stream
+from agents import GreedyAgent, load_agent, make_agent, seed_all
+from trajectory import TrajectoryWriter
+from convergence import ConvergenceMonitor
+from experience import ExperienceReplay
+from policy import PolicyTable
+from multiprocessing import Pool
+import numpy as np
+import argparse
+import sweep
+import json
+import sys
+import os
 
 
-def main():
+def main(argv=None):
+    """Entry point: run a subcommand, or the interactive demo menu if none"""
+    args = parse_args(argv)
+    if args.command is None:
+        menu()
+    elif args.command == 'corpus':
+        save_corpus(args.output, args.count, args.rows, args.cols, args.seed)
+    elif args.command == 'compare':
+        scores = compare_agents(args.episodes, args.processes, args.seed,
+                                args.rows, args.cols, args.steps, args.trials,
+                                args.corpus)
+        _write_results(args.output, vars(args), scores)
+        if args.plot:
+            plot_scores(scores)
+    elif args.command == 'train':
+        seed_all(args.seed)
+        if args.resume:
+            agent = load_agent(args.checkpoint)
+        else:
+            agent = make_agent(args.agent)
+        agent.stop_without_food = args.stop_without_food
+        if args.replay is not None:
+            agent.replay = ExperienceReplay(args.replay, args.batch_size,
+                                            args.replay_interval, args.seed)
+        boards = _board_source(args.corpus)
+        if args.lazy:
+            boards = board_stream(args.rows, args.cols, args.seed, lazy=True)
+        monitor = None
+        if args.early_stop is not None:
+            monitor = ConvergenceMonitor(args.early_stop, args.tolerance,
+                                         args.weight_tolerance)
+        if args.record is None:
+            rewards = agent.train(args.episodes, False, args.rows, args.cols,
+                                  args.steps, boards,
+                                  checkpoint=args.checkpoint, monitor=monitor)
+        else:
+            with TrajectoryWriter(args.record) as writer:
+                rewards = agent.train(args.episodes, False, args.rows,
+                                      args.cols, args.steps, boards,
+                                      args.record_every, writer,
+                                      args.checkpoint, monitor=monitor)
+        results = {args.agent: rewards}
+        if monitor is not None:
+            results['stop_episode'] = monitor.stop_episode
+            results['stop_reason'] = monitor.stop_reason
+        _write_results(args.output, vars(args), results)
+    elif args.command == 'simulate':
+        seed_all(args.seed)
+        run_simulation(args.agent, args.episodes > 0, args.rows, args.cols,
+                       args.steps, args.episodes, args.corpus,
+                       args.checkpoint)
+    elif args.command == 'sweep':
+        results = sweep.run_sweep(_sweep_configs(args), args.cache,
+                                  args.processes)
+        _write_results(args.output, vars(args), results)
+    elif args.command == 'compile':
+        seed_all(args.seed)
+        policy = PolicyTable.compile(load_agent(args.checkpoint))
+        policy.save(args.output)
+        rewards = policy.play(args.games, args.rows, args.cols, args.steps)
+        print('{} policy of {} perceptions: average reward {} in {} '
+              'games'.format(policy.kind.__name__, len(policy.table),
+                             rewards.mean(), args.games))
+    elif args.command == 'evaluate':
+        seed_all(args.seed)
+        agent = load_agent(args.checkpoint)
+        agent.stop_without_food = args.stop_without_food
+        boards = _board_source(args.corpus)
+        if args.record is None:
+            stats = agent.evaluate(args.games, args.rows, args.cols,
+                                   args.steps, boards)
+        else:
+            with TrajectoryWriter(args.record) as writer:
+                stats = agent.evaluate(args.games, args.rows, args.cols,
+                                       args.steps, boards, writer)
+        _write_results(args.output, vars(args), stats)
+    elif args.command == 'replay':
+        run_replay(args.file, args.index)
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments of the headless interface"""
+    parser = argparse.ArgumentParser(
+        description='Train and compare agents in the Flatland environment. '
+        'Without a command, the interactive demo menu is shown.')
+    commands = parser.add_subparsers(dest='command')
+
+    corpus = commands.add_parser(
+        'corpus', help='generate a corpus of boards and store it on disk')
+    corpus.add_argument('output', help='.npy file to store the corpus in')
+    corpus.add_argument('--count', type=int, default=10000,
+                        help='number of boards (default: %(default)s)')
+    corpus.add_argument('--rows', type=int, default=10,
+                        help='rows of each board (default: %(default)s)')
+    corpus.add_argument('--cols', type=int, default=10,
+                        help='columns of each board (default: %(default)s)')
+    corpus.add_argument('--seed', type=int, default=None,
+                        help='seed of the random generator')
+
+    compare = commands.add_parser(
+        'compare', help='train every agent and compare their rewards')
+    _add_common_arguments(compare, episodes=50)
+    compare.add_argument('--trials', type=int, default=1000,
+                         help='games used to score the GreedyAgent')
+    compare.add_argument('--processes', type=int, default=None,
+                         help='worker processes (default: run serially)')
+    compare.add_argument('--output', default=None,
+                         help='JSON file to write the reward curves to')
+    compare.add_argument('--plot', action='store_true',
+                         help='plot the reward curves with matplotlib')
+
+    train = commands.add_parser('train', help='train a single learning agent')
+    _add_common_arguments(train, episodes=50)
+    train.add_argument('--agent', choices='sre', default='s',
+                       help='supervised, reinforcement or enhanced agent')
+    train.add_argument('--output', default=None,
+                       help='JSON file to write the reward curve to')
+    train.add_argument('--record', default=None,
+                       help='trajectory file to append the recorded games to')
+    train.add_argument('--record-every', type=int, default=100,
+                       help='record one of every N training games '
+                       '(default: %(default)s)')
+    train.add_argument('--stop-without-food', action='store_true',
+                       help='end each game once no food is left')
+    train.add_argument('--lazy', action='store_true',
+                       help='generate the cells of the boards as they are '
+                       'seen, for boards of any size')
+    train.add_argument('--checkpoint', default=None,
+                       help='file to save the agent to after each episode')
+    train.add_argument('--resume', action='store_true',
+                       help='continue training the agent in --checkpoint')
+    train.add_argument('--early-stop', type=int, default=None,
+                       metavar='WINDOW',
+                       help='stop once the mean reward of the last WINDOW '
+                       'episodes improves less than --tolerance')
+    train.add_argument('--tolerance', type=float, default=0.1,
+                       help='minimum improvement of the mean reward '
+                       '(default: %(default)s)')
+    train.add_argument('--weight-tolerance', type=float, default=None,
+                       help='also require the relative change of the weights '
+                       'along the window to be below this value')
+    train.add_argument('--replay', type=int, default=None, metavar='CAPACITY',
+                       help='learn from an experience replay of this many '
+                       'transitions (reinforcement agents only)')
+    train.add_argument('--batch-size', type=int, default=32,
+                       help='transitions of each replay minibatch '
+                       '(default: %(default)s)')
+    train.add_argument('--replay-interval', type=int, default=4,
+                       help='steps between replay minibatches '
+                       '(default: %(default)s)')
+
+    simulate = commands.add_parser(
+        'simulate', help='train an agent and open the visual simulation')
+    _add_common_arguments(simulate, episodes=0)
+    simulate.add_argument('--agent', choices='gsre', default='g',
+                          help='greedy, supervised, reinforcement or enhanced')
+    simulate.add_argument('--checkpoint', default=None,
+                          help='load the agent from this file if it exists, '
+                          'or save it there after training otherwise')
+
+    search = commands.add_parser(
+        'sweep', help='train agents over a grid or a random sample of '
+        'hyperparameters, caching the results of each run')
+    search.add_argument('--agent', default='r',
+                        help='comma separated kinds of agent (s, r or e)')
+    search.add_argument('--learning-rate', default='0.005',
+                        help='comma separated values, or LOW:HIGH with '
+                        '--samples')
+    search.add_argument('--discount', default='0.99',
+                        help='comma separated values, or LOW:HIGH with '
+                        '--samples')
+    search.add_argument('--decay', default='1',
+                        help='comma separated values, or LOW:HIGH with '
+                        '--samples')
+    search.add_argument('--episodes', default='50',
+                        help='comma separated numbers of training episodes')
+    search.add_argument('--sizes', default='10x10',
+                        help='comma separated board sizes, as ROWSxCOLS')
+    search.add_argument('--steps', type=int, default=50,
+                        help='steps of each game (default: %(default)s)')
+    search.add_argument('--seeds', default='0',
+                        help='comma separated seeds of each configuration')
+    search.add_argument('--samples', type=int, default=None,
+                        help='sample this many configurations at random '
+                        'instead of running the whole grid')
+    search.add_argument('--sample-seed', type=int, default=None,
+                        help='seed of the random sample of configurations')
+    search.add_argument('--cache', default='sweep-cache',
+                        help='directory of the cache of finished runs '
+                        '(default: %(default)s)')
+    search.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: run serially)')
+    search.add_argument('--output', default=None,
+                        help='JSON file to write the reward curves to')
+
+    compile = commands.add_parser(
+        'compile', help='compile a trained agent into a policy lookup table')
+    compile.add_argument('checkpoint', help='checkpoint of the trained agent')
+    compile.add_argument('output', help='.npz file to store the table in')
+    compile.add_argument('--games', type=int, default=10000,
+                         help='games played with the table to score it '
+                         '(default: %(default)s)')
+    compile.add_argument('--rows', type=int, default=10,
+                         help='rows of each board (default: %(default)s)')
+    compile.add_argument('--cols', type=int, default=10,
+                         help='columns of each board (default: %(default)s)')
+    compile.add_argument('--steps', type=int, default=50,
+                         help='steps of each game (default: %(default)s)')
+    compile.add_argument('--seed', type=int, default=None,
+                         help='seed of the random generators')
+
+    evaluate = commands.add_parser(
+        'evaluate', help='score a trained agent with its weights frozen')
+    evaluate.add_argument('checkpoint', help='checkpoint of the trained agent')
+    evaluate.add_argument('--games', type=int, default=10000,
+                          help='games to play (default: %(default)s)')
+    evaluate.add_argument('--rows', type=int, default=10,
+                          help='rows of each board (default: %(default)s)')
+    evaluate.add_argument('--cols', type=int, default=10,
+                          help='columns of each board (default: %(default)s)')
+    evaluate.add_argument('--steps', type=int, default=50,
+                          help='steps of each game (default: %(default)s)')
+    evaluate.add_argument('--seed', type=int, default=None,
+                          help='seed of the random generators')
+    evaluate.add_argument('--corpus', default=None,
+                          help='corpus of boards to play instead of random '
+                          'ones (overrides --rows and --cols)')
+    evaluate.add_argument('--stop-without-food', action='store_true',
+                          help='end each game once no food is left')
+    evaluate.add_argument('--record', default=None,
+                          help='trajectory file to record every game to, '
+                          'playing them one by one')
+    evaluate.add_argument('--output', default=None,
+                          help='JSON file to write the statistics to')
+
+    replay = commands.add_parser(
+        'replay', help='open the games of a trajectory file in the simulation')
+    replay.add_argument('file',
+                        help='trajectory file written by train --record')
+    replay.add_argument('--index', type=int, default=0,
+                        help='index of the first game shown '
+                        '(default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'resume', False) and args.checkpoint is None:
+        parser.error('--resume requires a --checkpoint to resume from')
+    if getattr(args, 'replay', None) is not None and args.agent == 's' and \
+            not args.resume:
+        parser.error('--replay requires a reinforcement agent (r or e)')
+    if getattr(args, 'lazy', False) and args.corpus is not None:
+        parser.error('--lazy cannot be used with --corpus')
+    if args.command == 'sweep' and \
+            not set(args.agent.split(',')) <= set('sre'):
+        parser.error('--agent takes comma separated kinds of learning agent '
+                     '(s, r or e)')
+    if getattr(args, 'lazy', False) and args.stop_without_food:
+        parser.error('--stop-without-food cannot be used with --lazy, since '
+                     'lazy boards cannot count their food')
+    return args
+
+
+def _add_common_arguments(parser, episodes):
+    """Add the options shared by every command to a subcommand parser"""
+    parser.add_argument('--episodes', type=int, default=episodes,
+                        help='training episodes of 100 games '
+                        '(default: %(default)s)')
+    parser.add_argument('--rows', type=int, default=10,
+                        help='rows of each board (default: %(default)s)')
+    parser.add_argument('--cols', type=int, default=10,
+                        help='columns of each board (default: %(default)s)')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='steps of each game (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the random generators')
+    parser.add_argument('--corpus', default=None,
+                        help='corpus of boards to use instead of random ones '
+                        '(overrides --rows and --cols)')
+
+
+def _sweep_configs(args):
+    """Build the configurations of a sweep from its command line arguments"""
+    def values(text, cast):
+        # LOW:HIGH is a range to sample from, anything else a list of values
+        if args.samples is not None and ':' in text:
+            return tuple(cast(v) for v in text.split(':'))
+        return [cast(v) for v in text.split(',')]
+
+    space = {'agent': args.agent.split(','),
+             'learning_rate': values(args.learning_rate, float),
+             'discount': values(args.discount, float),
+             'decay': values(args.decay, float),
+             'episodes': values(args.episodes, int),
+             'size': [tuple(int(n) for n in size.split('x'))
+                      for size in args.sizes.split(',')],
+             'steps': [args.steps],
+             'seed': values(args.seeds, int)}
+    if args.samples is None:
+        return sweep.grid(**space)
+    # Integer ranges cannot be sampled uniformly, so they are lists here
+    for name in ('episodes', 'seed'):
+        if isinstance(space[name], tuple):
+            low, high = space[name]
+            space[name] = list(range(low, high + 1))
+    return sweep.sample(args.samples, args.sample_seed, **space)
+
+
+def _write_results(path, config, results):
+    """Write a run configuration and its results as JSON (stdout if no path)"""
+    config = {k: v for k, v in config.items() if k not in ('output', 'plot')}
+    document = {'config': config, 'results': results}
+    if path is None:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=2)
+
+
+def menu():
+    """Show the interactive menu used in the demo presentation"""
 
     print("""
     Demo for IT3708 - Project 1:
@@ -40,86 +367,163 @@ def main():
     elif choice == '7':
         run_simulation('e', False)
     elif choice == '8':
-        compare_agents(50)
+        plot_scores(compare_agents(50))
     else:
         print("The option entered was not valid.")
 
 
-def compare_agents(rounds):
-    """Run each of the agents, train them and compare them in a plot
+def _board_source(corpus, start=0):
+    """Return an endless stream of boards from a corpus file, if any"""
+    if corpus is None:
+        return None
+    return BoardCorpus(corpus).stream(start)
+
+
+def _greedy_trials(task):
+    """Run a chunk of GreedyAgent trials and return the sum of rewards"""
+    seed, trials, rows, cols, steps, corpus, start = task
+    seed_all(seed)
+    boards = _board_source(corpus, start)
+    agent = GreedyAgent()
+    sum_reward = 0
+    for _ in range(trials):
+        board = Flatland(rows, cols) if boards is None else next(boards)
+        agent.new_environment(board)
+        agent.run(steps, False)
+        sum_reward += agent.reward
+    return sum_reward
+
+
+def _train_agent(task):
+    """Train a new agent of a given kind and return its rewards curve"""
+    kind, rounds, seed, rows, cols, steps, corpus = task
+    seed_all(seed)
+    agent = make_agent(kind)
+    return agent.train(rounds, False, rows, cols, steps,
+                       _board_source(corpus))
+
+
+def compare_agents(rounds, processes=None, seed=None, rows=10, cols=10,
+                   steps=50, trials=1000, corpus=None):
+    """Run each of the agents, train them and return their reward curves
+
+    The greedy trials are split in chunks and, along with the training of each
+    learning agent, run as independent tasks. Each task gets its own random
+    stream derived from the seed, so the results only depend on the seed and
+    not on the number of processes used. If a corpus is given, every agent
+    plays in the same boards: the greedy trials take consecutive boards of
+    the corpus, and all the trainings go through it from the start.
 
     Arguments:
     rounds -- Number of training rounds to run in each agent
+    processes -- Number of worker processes, None to run everything serially
+    seed -- Seed of the random streams, None for a random one
+    rows -- Number of rows of the boards
+    cols -- Number of columns of the boards
+    steps -- Number of steps of each game
+    trials -- Number of games used to score the GreedyAgent
+    corpus -- Path of a corpus of boards to use instead of random boards
     """
-    # Greedy agent measure
-    agent_g = GreedyAgent()
-    sum_reward = 0
-    trials = 1000
-    print('Starting: GreedyAgent in {} trials:'.format(trials))
-    for _ in range(trials):
-        board = Flatland(10, 10)
-        agent_g.new_environment(board)
-        agent_g.run(50, False)
-        sum_reward += agent_g.reward
-    greedy_avg = sum_reward/trials
-    print('Average score obtained: ', greedy_avg)
+    chunks = 20
+    streams = np.random.SeedSequence(seed).spawn(chunks + 3)
+    seeds = [int(stream.generate_state(1)[0]) for stream in streams]
+    sizes = [trials // chunks + (i < trials % chunks) for i in range(chunks)]
+    starts = [sum(sizes[:i]) for i in range(chunks)]
+    greedy_tasks = [(seeds[i], sizes[i], rows, cols, steps, corpus, starts[i])
+                    for i in range(chunks)]
+    train_tasks = [(kind, rounds, seeds[chunks + i], rows, cols, steps, corpus)
+                   for i, kind in enumerate('sre')]
+
+    # Progress goes to stderr, so that the results can be written to stdout
+    print('Starting: GreedyAgent in {} trials'.format(trials),
+          file=sys.stderr)
+    print('Training: SupervisedAgent, ReinforcementAgent and EnhancedAgent',
+          file=sys.stderr)
+    if processes is None:
+        greedy_sums = list(map(_greedy_trials, greedy_tasks))
+        scores = list(map(_train_agent, train_tasks))
+    else:
+        with Pool(processes) as pool:
+            # Launch the long trainings first so they start right away
+            training = pool.map_async(_train_agent, train_tasks)
+            greedy_sums = pool.map(_greedy_trials, greedy_tasks)
+            scores = training.get()
+    print(file=sys.stderr)
+
+    greedy_avg = sum(greedy_sums)/trials
+    print('GreedyAgent average score obtained: ', greedy_avg,
+          file=sys.stderr)
     greedy_score = [greedy_avg for _ in range(rounds)]
-    print()
-
-    print('Training the SupervisedAgent:')
-    # Supervised agent measure
-    agent_s = SupervisedAgent(0.01)
-    supervised_score = agent_s.train(rounds, False)
-    print()
-
-    print('Training the ReinforcementAgent:')
-    # Reinforcement agent measure
-    agent_r = ReinforcementAgent(0.005, 0.99, 1)
-    reinforced_score = agent_r.train(rounds, False)
-    print()
-
-    print('Training the EnhancedAgent:')
-    # Enhanced agent measure
-    agent_e = EnhancedAgent(0.005, 0.99, 1)
-    enhanced_score = agent_e.train(rounds, False)
-    print()
+    supervised_score, reinforced_score, enhanced_score = scores
+    print(file=sys.stderr)
+
+    return {'greedy': greedy_score,
+            'supervised': supervised_score,
+            'reinforcement': reinforced_score,
+            'enhanced': enhanced_score}
+
+
+def plot_scores(scores):
+    """Plot the reward curves returned by compare_agents"""
+    import matplotlib.pyplot as plt
 
     plt.figure()
-    plt.plot(greedy_score, label='Greedy Agent', ls='dashed')
-    plt.plot(supervised_score, label='Supervised Agent')
-    plt.plot(reinforced_score, label='Reinforced Agent')
-    plt.plot(enhanced_score, label='Enhanced Agent')
+    plt.plot(scores['greedy'], label='Greedy Agent', ls='dashed')
+    plt.plot(scores['supervised'], label='Supervised Agent')
+    plt.plot(scores['reinforcement'], label='Reinforced Agent')
+    plt.plot(scores['enhanced'], label='Enhanced Agent')
     plt.legend(loc='lower right')
     plt.show()
 
 
-def run_simulation(agent, training):
+def run_simulation(agent, training, rows=10, cols=10, steps=50, episodes=20,
+                   corpus=None, checkpoint=None):
     """Run the graphical simulation after training the agent
 
+    If a checkpoint is given and exists, the agent is loaded from it instead
+    of being trained. Otherwise it is saved there while training.
+
     Arguments:
-    agent -- type of the agent to launch in the simulation"""
-    if agent == 'g':
-        agent = GreedyAgent()
-    elif agent == 's':
-        agent = SupervisedAgent(0.01)
-    elif agent == 'r':
-        agent = ReinforcementAgent(0.005, 0.99, 1)
-    elif agent == 'e':
-        agent = EnhancedAgent(0.005, 0.99, 1)
-
-    if training:
-        env = Flatland(10, 10)
-        agent.train(20, False)
-        agent.new_environment(env)
-        agent.learn(50, False)
+    agent -- type of the agent to launch in the simulation
+    training -- True to train the agent before launching the simulation
+    rows -- number of rows of the boards
+    cols -- number of columns of the boards
+    steps -- number of steps of each game
+    episodes -- number of training episodes, if training
+    corpus -- path of a corpus of boards to use instead of random boards
+    checkpoint -- path of the checkpoint of the agent"""
+    # Import the graphical modules only when they are needed
+    from window import Simulation
+
+    boards = _board_source(corpus)
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        agent = load_agent(checkpoint)
     else:
-        env = Flatland(10, 10)
-        agent.new_environment(env)
-        if isinstance(agent, GreedyAgent):
-            agent.run(50, False)
-        else:
-            agent.learn(50, False)
-    simulation = Simulation(agent)
+        agent = make_agent(agent)
+        if training:
+            agent.train(episodes, False, rows, cols, steps, boards,
+                        checkpoint=checkpoint)
+    env = Flatland(rows, cols) if boards is None else next(boards)
+    agent.new_environment(env)
+    # Agents that do not learn, as the GreedyAgent, just play the game
+    if hasattr(agent, 'learn'):
+        agent.learn(steps, False)
+    else:
+        agent.run(steps, False)
+    simulation = Simulation(agent, boards)
+    simulation.start()
+
+
+def run_replay(path, index=0):
+    """Open the games of a trajectory file in the graphical simulation
+
+    Arguments:
+    path -- path of the trajectory file
+    index -- index of the first game shown"""
+    from window import Simulation
+
+    simulation = Simulation.replay(path, index)
     simulation.start()
 
 
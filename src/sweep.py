@@ -0,0 +1,188 @@
+from agents import SupervisedAgent, ReinforcementAgent, kinds, seed_all
+from multiprocessing import Pool
+import numpy as np
+import itertools
+import hashlib
+import json
+import os
+import sys
+
+
+# Default value of each parameter of a run, the demo parameters of the agents
+defaults = {'agent': 'r',
+            'learning_rate': 0.005,
+            'discount': 0.99,
+            'decay': 1,
+            'episodes': 50,
+            'rows': 10,
+            'cols': 10,
+            'steps': 50,
+            'seed': 0}
+
+# Source files whose changes can change the result of a run
+_sources = ('agents.py', 'flatland.py', 'sweep.py')
+
+
+def grid(**space):
+    """Returns the configurations of every combination of the given values
+
+    Each keyword is a parameter of the runs (see defaults) and takes a list
+    of values. The special keyword size takes (rows, cols) pairs. Parameters
+    not given take their default value.
+
+    Example: grid(agent=['r', 'e'], learning_rate=[0.001, 0.01], seed=[0, 1])
+    """
+    names = list(space)
+    configs = []
+    for values in itertools.product(*(space[name] for name in names)):
+        configs.append(_config(dict(zip(names, values))))
+    return configs
+
+
+def sample(count, sampling_seed=None, **space):
+    """Returns a number of configurations sampled at random
+
+    Each keyword is a parameter of the runs and takes either a list of values
+    to choose from, or a (low, high) tuple to sample uniformly from. The
+    special keyword size takes a list of (rows, cols) pairs.
+
+    Arguments:
+    count -- number of configurations to sample
+    sampling_seed -- seed of the sampling, None for a random one
+    """
+    rng = np.random.default_rng(sampling_seed)
+    configs = []
+    for _ in range(count):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                config[name] = float(rng.uniform(*values))
+            else:
+                config[name] = values[rng.integers(len(values))]
+        configs.append(_config(config))
+    return configs
+
+
+def _config(values):
+    """Complete a configuration with the default values"""
+    config = dict(defaults)
+    if 'size' in values:
+        values = dict(values)
+        config['rows'], config['cols'] = values.pop('size')
+    config.update(values)
+    _agent_class(config['agent'])
+    return config
+
+
+def _agent_class(kind):
+    """Returns the class of a kind of agent, if it is one that learns
+
+    Raises a ValueError for unknown kinds and for the GreedyAgent, which has
+    no hyperparameters to search.
+    """
+    cls = kinds.get(kind)
+    if cls is None or not issubclass(cls, SupervisedAgent):
+        raise ValueError('{!r} is not a kind of learning agent'.format(kind))
+    return cls
+
+
+def code_version():
+    """Returns a hash of the source code the results of a run depend on"""
+    digest = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in _sources:
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def cache_key(config, version):
+    """Returns the key of a run in the cache
+
+    The key identifies the class of the agent, the parameters it uses, the
+    seed and the version of the code. Parameters an agent does not use, as
+    the discount of a SupervisedAgent, are left out so equal runs share it.
+    """
+    cls = _agent_class(config['agent'])
+    ignored = set() if issubclass(cls, ReinforcementAgent) else \
+        {'discount', 'decay'}
+    params = {name: value for name, value in config.items()
+              if name != 'agent' and name not in ignored}
+    text = json.dumps([cls.__name__, params, version], sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def run(config):
+    """Train an agent with a configuration and return its reward curve"""
+    seed_all(config['seed'])
+    cls = _agent_class(config['agent'])
+    if issubclass(cls, ReinforcementAgent):
+        agent = cls(config['learning_rate'], config['discount'],
+                    config['decay'])
+    else:
+        agent = cls(config['learning_rate'])
+    return agent.train(config['episodes'], False, config['rows'],
+                       config['cols'], config['steps'])
+
+
+def run_sweep(configs, cache, processes=None):
+    """Run every configuration not in the cache and return all the results
+
+    Each finished run is written to the cache directory right away, so an
+    interrupted sweep only loses the runs in progress. Returns a list with a
+    {'config': ..., 'rewards': ...} dictionary per configuration, in order.
+
+    Arguments:
+    configs -- list of configurations, as returned by grid or sample
+    cache -- directory of the cache, created if it does not exist
+    processes -- number of worker processes, None to run serially
+    """
+    os.makedirs(cache, exist_ok=True)
+    version = code_version()
+    keys = [cache_key(config, version) for config in configs]
+    results = {}
+    for key in set(keys):
+        path = os.path.join(cache, key + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                results[key] = json.load(f)['rewards']
+
+    # Run each missing configuration once, even if repeated
+    missing = {}
+    for key, config in zip(keys, configs):
+        if key not in results:
+            missing[key] = config
+    print('Sweep: {} runs, {} cached, {} to run'.format(
+        len(configs), len(configs) - len(missing), len(missing)),
+        file=sys.stderr)
+
+    def collect(finished):
+        for i, (key, rewards) in enumerate(finished):
+            _store(os.path.join(cache, key + '.json'), missing[key], rewards)
+            results[key] = rewards
+            print('Run {}/{} finished'.format(i + 1, len(missing)),
+                  file=sys.stderr)
+
+    tasks = list(missing.items())
+    if processes is None:
+        collect(map(_run_task, tasks))
+    else:
+        with Pool(processes) as pool:
+            collect(pool.imap_unordered(_run_task, tasks))
+
+    return [{'config': config, 'rewards': results[key]}
+            for key, config in zip(keys, configs)]
+
+
+def _run_task(task):
+    """Run a (key, config) task in a worker process"""
+    key, config = task
+    return key, run(config)
+
+
+def _store(path, config, rewards):
+    """Write the result of a run to the cache through a temporary file"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'config': config, 'rewards': rewards}, f)
+    os.replace(tmp, path)
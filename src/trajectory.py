@@ -0,0 +1,350 @@
+from flatland import Flatland
+from collections.abc import Sequence
+import numpy as np
+import struct
+import zlib
+
+
+class Trajectory():
+    """Columnar record of the game played by an agent
+
+    Instead of growing Python lists with a tuple or a copy of the neurons per
+    step, a Trajectory stores the game in preallocated typed arrays that grow
+    by doubling their capacity:
+    - positions: (x, y) pairs of int64, one per position visited.
+    - rewards: reward obtained when reaching each position, as int16.
+    - neurons: snapshot of the input neurons of each decision, with the
+    neurons packed as bits.
+    - outputs: output neuron chosen in each decision, as uint8.
+
+    The columns can be read through the steps, neuron_story and output_story
+    sequences, which behave like the lists the agents used to keep.
+
+    Public attributes:
+    n_neurons -- number of input neurons of each snapshot
+    steps -- sequence of the (x, y) positions visited
+    reward_story -- sequence of the rewards obtained in each position
+    neuron_story -- sequence of the neuron snapshots, unpacked
+    output_story -- sequence of the outputs chosen
+    """
+
+    def __init__(self, n_neurons=0, capacity=64):
+        """Creates an empty trajectory for an agent with n_neurons inputs"""
+        self.n_neurons = n_neurons
+        self._positions = np.empty((capacity, 2), dtype=np.int64)
+        self._rewards = np.empty(capacity, dtype=np.int16)
+        self._neurons = np.empty((capacity, (n_neurons + 7) // 8),
+                                 dtype=np.uint8)
+        self._outputs = np.empty(capacity, dtype=np.uint8)
+        self._n_positions = 0
+        self._n_decisions = 0
+
+        self.steps = _Column(self, 'position')
+        self.reward_story = _Column(self, 'reward')
+        self.neuron_story = _Column(self, 'snapshot')
+        self.output_story = _Column(self, 'output')
+
+    @classmethod
+    def from_arrays(cls, positions, rewards, neurons, outputs, n_neurons):
+        """Creates a trajectory from its columns, with the neurons packed"""
+        trajectory = cls(n_neurons, capacity=0)
+        trajectory._positions = positions
+        trajectory._rewards = rewards
+        trajectory._neurons = neurons
+        trajectory._outputs = outputs
+        trajectory._n_positions = len(positions)
+        trajectory._n_decisions = len(outputs)
+        return trajectory
+
+    def add_position(self, position, reward=0):
+        """Record a new position visited by the agent and its reward"""
+        n = self._n_positions
+        if n == len(self._positions):
+            self._positions = _grow(self._positions)
+            self._rewards = _grow(self._rewards)
+        self._positions[n] = position
+        self._rewards[n] = reward
+        self._n_positions = n + 1
+
+    def add_decision(self, neurons, output):
+        """Record the input neurons and the output chosen in a decision"""
+        n = self._n_decisions
+        if n == len(self._outputs):
+            self._neurons = _grow(self._neurons)
+            self._outputs = _grow(self._outputs)
+        self._neurons[n] = np.packbits(neurons > 0)
+        self._outputs[n] = output
+        self._n_decisions = n + 1
+
+    def positions(self):
+        """Returns the (n, 2) array of positions recorded"""
+        return self._positions[:self._n_positions]
+
+    def rewards(self):
+        """Returns the array of rewards recorded"""
+        return self._rewards[:self._n_positions]
+
+    def neurons(self):
+        """Returns the (n, n_neurons) array of neuron snapshots recorded"""
+        return np.unpackbits(self._neurons[:self._n_decisions], axis=1,
+                             count=self.n_neurons)
+
+    def outputs(self):
+        """Returns the array of outputs recorded"""
+        return self._outputs[:self._n_decisions]
+
+    def _position(self, i):
+        x, y = self._positions[i].tolist()
+        return (x, y)
+
+    def _reward(self, i):
+        return int(self._rewards[i])
+
+    def _snapshot(self, i):
+        return np.unpackbits(self._neurons[i], count=self.n_neurons)
+
+    def _output(self, i):
+        return int(self._outputs[i])
+
+
+def _grow(array):
+    """Return a copy of an array with twice its capacity"""
+    bigger = np.empty((max(2 * len(array), 1),) + array.shape[1:],
+                      dtype=array.dtype)
+    bigger[:len(array)] = array
+    return bigger
+
+
+class _Column(Sequence):
+    """Read-only sequence over one of the columns of a Trajectory
+
+    The column is either 'position', 'reward', 'snapshot' or 'output', and
+    its items are read with the method of the trajectory with that name.
+    """
+
+    def __init__(self, trajectory, column):
+        self._trajectory = trajectory
+        self._column = column
+
+    def __len__(self):
+        if self._column in ('position', 'reward'):
+            return self._trajectory._n_positions
+        return self._trajectory._n_decisions
+
+    def __getitem__(self, i):
+        read = getattr(self._trajectory, '_' + self._column)
+        n = len(self)
+        if isinstance(i, slice):
+            return [read(k) for k in range(*i.indices(n))]
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('trajectory index out of range')
+        return read(i)
+
+
+# Trajectory files start with a magic string and a version number, followed
+# by a chunk per game. Each chunk is a header with the size of the board
+# stored, the number of items of each column, the size of its payload and the
+# coordinates of the first cell of the board stored, and then the payload
+# itself: the original board, the positions, the rewards, the packed neurons,
+# the outputs and, optionally, the weights of the agent.
+#
+# The board stored is the region of the board in play (see Flatland.region),
+# which is only part of it for lazy boards, and the positions are relative to
+# it. Files of version 1 stored whole boards, with int16 positions and no
+# coordinates, and can still be read.
+_MAGIC = b'FLTJ'
+_VERSION = 2
+_HEADER = struct.Struct('<4sB')
+_CHUNKS = {1: struct.Struct('<IIIIIHB'),
+           2: struct.Struct('<IIIIIHBqq')}
+_CHUNK = _CHUNKS[_VERSION]
+
+# Type of the positions stored by each version
+_POSITIONS = {1: np.int16, 2: np.int32}
+
+# Flags of each chunk
+_COMPRESSED = 1
+_WEIGHTS = 2
+
+
+class TrajectoryWriter():
+    """Appends the games played by agents to a trajectory file
+
+    Each game is stored as an independent chunk, optionally compressed with
+    zlib, so that writing a game costs a single write call and files can be
+    extended later on. The writer can be used as a context manager.
+    """
+
+    def __init__(self, path, compress=True):
+        """Opens a trajectory file for appending, creating it if needed
+
+        Only files of the current version can be extended.
+        """
+        self.compress = compress
+        self._file = open(path, 'a+b')
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+        else:
+            self._file.seek(0)
+            magic, version = _HEADER.unpack(self._file.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION:
+                self._file.close()
+                raise ValueError('{} is not a version {} trajectory '
+                                 'file'.format(path, _VERSION))
+
+    def write(self, agent):
+        """Appends the game recorded by an agent (see Agent.record)"""
+        trajectory = agent.trajectory
+        env = agent.environment
+        x, y, cols, rows = env.region()
+        board = env.original_cells(x, y, cols, rows)
+        positions = trajectory.positions() - (x, y)
+        limit = np.iinfo(_POSITIONS[_VERSION])
+        if len(positions) and not \
+                limit.min <= positions.min() <= positions.max() <= limit.max:
+            raise ValueError('positions too far away from the board stored')
+        parts = [board.tobytes(),
+                 positions.astype(_POSITIONS[_VERSION]).tobytes(),
+                 trajectory.rewards().tobytes(),
+                 trajectory._neurons[:trajectory._n_decisions].tobytes(),
+                 trajectory.outputs().tobytes()]
+
+        flags = 0
+        weights = getattr(agent, 'weights', None)
+        if weights is not None:
+            flags |= _WEIGHTS
+            parts.append(weights.astype(np.float32).tobytes())
+        payload = b''.join(parts)
+        if self.compress:
+            flags |= _COMPRESSED
+            payload = zlib.compress(payload, 1)
+
+        self._file.write(_CHUNK.pack(len(payload), rows, cols,
+                                     trajectory._n_positions,
+                                     trajectory._n_decisions,
+                                     trajectory.n_neurons, flags, x, y) +
+                         payload)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryReader():
+    """Random access to the games stored in a trajectory file
+
+    Opening a file only reads the chunk headers to index where each game
+    starts, so any game can be loaded without reading the ones before it.
+    The reader can be used as a context manager.
+    """
+
+    def __init__(self, path):
+        """Opens a trajectory file and indexes its games"""
+        self._file = open(path, 'rb')
+        magic, version = _HEADER.unpack(self._file.read(_HEADER.size))
+        if magic != _MAGIC or version not in _CHUNKS:
+            self._file.close()
+            raise ValueError('{} is not a trajectory file'.format(path))
+        self._chunk = _CHUNKS[version]
+        self._positions = _POSITIONS[version]
+
+        self._offsets = []
+        offset = _HEADER.size
+        header = self._file.read(self._chunk.size)
+        while len(header) == self._chunk.size:
+            self._offsets.append(offset)
+            offset += self._chunk.size + self._chunk.unpack(header)[0]
+            self._file.seek(offset)
+            header = self._file.read(self._chunk.size)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        """Returns the i-th game of the file as a Replay"""
+        self._file.seek(self._offsets[i])
+        size, rows, cols, n_positions, n_decisions, n_neurons, flags, \
+            *origin = self._chunk.unpack(self._file.read(self._chunk.size))
+        payload = self._file.read(size)
+        if flags & _COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        # Split the payload in its columns
+        columns = []
+        offset = 0
+        for dtype, shape in ((np.uint8, (rows, cols)),
+                             (self._positions, (n_positions, 2)),
+                             (np.int16, (n_positions,)),
+                             (np.uint8, (n_decisions, (n_neurons + 7) // 8)),
+                             (np.uint8, (n_decisions,)),
+                             (np.float32, (3, n_neurons))):
+            count = int(np.prod(shape))
+            column = np.frombuffer(payload, dtype, count, offset)
+            columns.append(column.reshape(shape))
+            offset += count * np.dtype(dtype).itemsize
+        board, positions, rewards, neurons, outputs, weights = columns
+
+        trajectory = Trajectory.from_arrays(positions.astype(np.int64),
+                                            rewards, neurons, outputs,
+                                            n_neurons)
+        if not flags & _WEIGHTS:
+            weights = None
+        return Replay(Flatland.from_cells(board), trajectory, weights,
+                      tuple(origin) or (0, 0))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Replay():
+    """A recorded game, which can be shown in a Simulation as an agent
+
+    Public attributes:
+    environment -- Flatland with the original board of the game, or the
+    region of it that was stored
+    trajectory -- Trajectory of the game, relative to that board
+    weights -- weights of the agent when the game was recorded, if any
+    neurons -- input neurons of the agent, all of them off
+    reward -- total reward obtained in the game
+    origin -- (x, y) coordinates in the board played of the first cell of
+    the board stored
+    """
+
+    record = False
+
+    def __init__(self, environment, trajectory, weights=None, origin=(0, 0)):
+        self.environment = environment
+        self.origin = origin
+        self.trajectory = trajectory
+        self.weights = weights
+        self.neurons = np.zeros(trajectory.n_neurons)
+        self.reward = int(trajectory.rewards().sum())
+
+    @property
+    def steps(self):
+        return self.trajectory.steps
+
+    @property
+    def neuron_story(self):
+        return self.trajectory.neuron_story
+
+    @property
+    def output_story(self):
+        return self.trajectory.output_story
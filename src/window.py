@@ -1,6 +1,8 @@
-from flatland import Flatland
-from agents import GreedyAgent, EnhancedAgent
+from trajectory import TrajectoryReader
+from collections import Counter
+import threading
 import pygame
+import queue
 
 
 class Simulation():
@@ -8,6 +10,10 @@ class Simulation():
 
     A Simulation generates a pygame screen in which the Flatland environment is
     rendered, along with the solution of an agent in it.
+
+    Visual trainings run in a background thread that publishes a snapshot of
+    the weights and rewards after each episode, so the window keeps handling
+    events and can pause or cancel the training at any moment.
     """
     # Colors defined for convinience
     _black = (0, 0, 0)
@@ -20,6 +26,13 @@ class Simulation():
     _wall = (200, 200, 200)
     _neuron_on = (100, 100, 200)
 
+    # Frames per second of the GUI loop, and delay between autoplay steps
+    _fps = 30
+    _autoplay_delay = 200
+
+    # Episodes of 100 games performed by a visual training
+    _training_episodes = 50
+
     # Grid coordinates and other parameters of size
     _grid_o = (20, 20)
     _cell_size = 40
@@ -27,6 +40,8 @@ class Simulation():
     # Brain coordinates and other parameters of size
     _input_spacing = 42
     _output_spacing = 170
+    _brain_width = 600
+    _brain_height = 520
 
     # Hardcoded meanings of each input neuron
     _input_meanings = {0: 'E front',
@@ -71,45 +86,106 @@ class Simulation():
                         1: 'Move left',
                         2: 'Move right'}
 
-    def __init__(self, agent):
-        """Creates a new Simulation given an agent and a environment"""
+    def __init__(self, agent, boards=None, replays=None):
+        """Creates a new Simulation given an agent and a environment
+
+        New boards, for new runs and visual trainings, are taken from the
+        boards iterator if given, or randomly generated otherwise. If a
+        TrajectoryReader is given as replays, the agent is the Replay of one
+        of its games, and new runs move through the games of the file instead.
+        """
         self.agent = agent
         self.env = agent.environment
-        self._only_grid = isinstance(self.agent, GreedyAgent)
+        self._boards = boards
+        self._replays = replays
+        self._replay_index = 0
+
+        # Init the font module
+        pygame.init()
+        self._font = pygame.font.SysFont("Consolas", 20)
+
+        self._step = 1
+        self._avg = None
+
+        # State of the loop, the autoplay and the visual training, if any
+        self._end = False
+        self._playing = False
+        self._next_play = 0
+        self._training = None
+        self._snapshots = queue.Queue()
+        self._resume = threading.Event()
+        self._cancel = threading.Event()
+        self._weights = None
+
+        self._layout()
+
+    @classmethod
+    def replay(cls, path, index=0):
+        """Creates a Simulation showing the games of a trajectory file
+
+        Arguments:
+        path -- path of a file written by a TrajectoryWriter
+        index -- index of the first game shown
+        """
+        replays = TrajectoryReader(path)
+        simulation = cls(replays[index], replays=replays)
+        simulation._replay_index = index
+        return simulation
+
+    def _layout(self):
+        """Compute the size of the window and the position of its elements
+
+        The layout depends on the region of the board shown, which is the
+        whole board but for lazy boards (see Flatland.region), and the number
+        of neurons of the agent, so it is computed again if they change.
+        """
+        self._only_grid = getattr(self.agent, 'weights', None) is None
+        self._input_spacing = Simulation._input_spacing
+        self._view = self.env.region()
+        view_x, view_y, view_cols, view_rows = self._view
         # Compute window size
-        self.height = (self.env.rows + 2) * self._cell_size + 2*self._grid_o[1]
-        self.width = (self.env.cols + 2) * self._cell_size + 2*self._grid_o[0]
+        self.height = (view_rows + 2) * self._cell_size + 2*self._grid_o[1]
+        self.width = (view_cols + 2) * self._cell_size + 2*self._grid_o[0]
+        self._grid_rect = pygame.Rect(
+            self._grid_o, ((view_cols + 2) * self._cell_size + 1,
+                           (view_rows + 2) * self._cell_size + 1))
         if not self._only_grid:
             # Compute the brain size and update window
-            self._brain_o = (self.height, 20)
-            self.height *= 2
+            self._brain_o = (self.width, 20)
+            self.width += self._brain_width
+            self.height = max(self.height, self._brain_height)
             self._input_o = self._brain_o
             self._input_n_o = (self._input_o[0] + 90, self._input_o[1] + 5)
             self._output_o = (self._input_o[0] + 350, 85)
             self._output_n_o = (self._output_o[0] - 20, 90)
             self._avg_o = (self._output_n_o[0], 480)
-            # Fine tune the spacing:
-            if isinstance(agent, EnhancedAgent):
+            # Fine tune the spacing of the enhanced perception:
+            if len(self.agent.neurons) > 12:
                 self._input_spacing = round(self._input_spacing / 3)
                 self._input_o = (self._brain_o[0], 10)
                 self._input_n_o = (self._input_o[0] + 90, self._input_o[1] + 5)
                 self._output_o = (self._input_o[0] + 350, 85)
                 self._output_n_o = (self._output_o[0] - 20, 90)
 
-        # Init the font module
-        pygame.init()
-        self._font = pygame.font.SysFont("Consolas", 20)
-
-        self._step = 1
-        self._avg = None
-
-        # Populate grid centers dictionary
+        # Layers cached between frames, built when the screen is created
+        self._static = None
+        self._cells = None
+        self._synapses = None
+        self._synapse_weights = None
+        self._drawn_step = None
+        self._drawn_neurons = None
+        # Number of visits to each position up to the step drawn
+        self._visited = Counter()
+
+        # Populate grid centers dictionary, with the cells of the region and
+        # the ones around it
         self._grid = {}
-        for i in range(-1, self.env.rows + 1):
-            for j in range(-1, self.env.cols + 1):
+        for i in range(view_x - 1, view_x + view_cols + 1):
+            for j in range(view_y - 1, view_y + view_rows + 1):
                 # Compute the corner of the cell
-                self._grid[i, j] = (self._grid_o[0] + (i+1.5)*self._cell_size,
-                                    self._grid_o[1] + (j+1.5)*self._cell_size)
+                self._grid[i, j] = (
+                    self._grid_o[0] + (i - view_x + 1.5)*self._cell_size,
+                    self._grid_o[1] + (j - view_y + 1.5)*self._cell_size)
                 # Round to int
                 self._grid[i, j] = (int(self._grid[i, j][0]),
                                     int(self._grid[i, j][1]))
@@ -131,199 +207,457 @@ class Simulation():
     def start(self):
         """Starts the simulation loop"""
         # Create the screen
-        self.screen = pygame.display.set_mode((self.height, self.width))
+        self.screen = pygame.display.set_mode((self.width, self.height))
+        self._set_caption()
         # Call the draw function to start
         self._draw_window()
-        # Intiate the GUI loop
-        end = False
-        while not end:
+        # Intiate the GUI loop at a steady frame rate
+        clock = pygame.time.Clock()
+        self._end = False
+        while not self._end:
             for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    end = True
-                    pygame.quit()
-
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_LEFT:
-                        self.previous_step()
-                    elif event.key == pygame.K_RIGHT:
-                        self.next_step()
-                    elif event.key == pygame.K_SPACE:
-                        self.run()
-                    elif event.key == pygame.K_t and not self._only_grid:
-                        self.visual_training()
-                    elif event.key == pygame.K_w and not self._only_grid:
-                        self.agent.print_weights()
-                    elif event.key == pygame.K_n:
-                        self._new_run()
+                self._handle_event(event)
+            self._poll_training()
+            self._poll_autoplay()
+            clock.tick(self._fps)
+        pygame.quit()
+        if self._replays is not None:
+            self._replays.close()
+
+    def _set_caption(self):
+        """Show the game displayed in the window title, when replaying"""
+        if self._replays is not None:
+            caption = 'Replay: game {} of {}, reward {}'.format(
+                self._replay_index + 1, len(self._replays), self.agent.reward)
+            pygame.display.set_caption(caption)
+
+    def _handle_event(self, event):
+        """React to a single pygame event"""
+        if event.type == pygame.QUIT:
+            self._end = True
+            self._stop_training()
+
+        if event.type != pygame.KEYDOWN:
+            return
+
+        # While training only the pause and cancel keys are available
+        if self._training is not None:
+            if event.key == pygame.K_p:
+                self._toggle_pause()
+            elif event.key in (pygame.K_c, pygame.K_ESCAPE):
+                self._stop_training()
+            return
+
+        if event.key == pygame.K_LEFT:
+            self._playing = False
+            self.previous_step()
+        elif event.key == pygame.K_RIGHT:
+            self._playing = False
+            self.next_step()
+        elif event.key == pygame.K_SPACE:
+            self.run()
+        elif self._replays is not None:
+            # Replays can only move through the games of the file
+            if event.key == pygame.K_n:
+                self._open_replay(self._replay_index + 1)
+            elif event.key == pygame.K_b:
+                self._open_replay(self._replay_index - 1)
+        elif event.key == pygame.K_t and not self._only_grid:
+            self.visual_training()
+        elif event.key == pygame.K_w and not self._only_grid:
+            self.agent.print_weights()
+        elif event.key == pygame.K_n:
+            self._new_run()
 
     def _points_to_coordinates(self, points):
         """Translate a list of points to coordinates in Simulation canvas"""
         return [self._grid[point] for point in points]
 
-    def _draw_window(self, training=False):
-        """Draws all the components in the window at a given time"""
-        # Draw a white background
-        self.screen.fill(self._white)
+    def _build_static(self):
+        """Render the parts of the window that never change
+
+        The static layer holds the grid, the walls and the labels of the
+        neurons. The cells layer starts as a copy of it, in which the food and
+        poison of the board are drawn (see _build_cells).
+        """
+        self._static = pygame.Surface(self.screen.get_size())
+        self._static.fill(self._white)
+        _, _, view_cols, view_rows = self._view
 
         # Draw vertical lines of the grid
-        for i in range(self.env.cols + 3):
+        for i in range(view_cols + 3):
             start = (self._grid_o[0] + i * self._cell_size,
                      self._grid_o[1])
             end = (self._grid_o[0] + i * self._cell_size,
-                   self._grid_o[1] + (self.env.rows + 2) * self._cell_size)
-            pygame.draw.lines(self.screen, self._black, False, [start, end], 1)
+                   self._grid_o[1] + (view_rows + 2) * self._cell_size)
+            pygame.draw.lines(self._static, self._black, False, [start, end],
+                              1)
 
         # Draw horizontal lines of the grid
-        for i in range(self.env.rows + 3):
+        for i in range(view_rows + 3):
             start = (self._grid_o[0],
                      self._grid_o[1] + i * self._cell_size)
-            end = (self._grid_o[0] + (self.env.cols + 2) * self._cell_size,
+            end = (self._grid_o[0] + (view_cols + 2) * self._cell_size,
                    self._grid_o[1] + i * self._cell_size)
-            pygame.draw.lines(self.screen, self._black, False, [start, end], 1)
+            pygame.draw.lines(self._static, self._black, False, [start, end],
+                              1)
 
-        steps = self.agent.steps[:self._step]
+        # Draw the walls around the board, if in sight
+        for i, j in self._grid:
+            if self.env.get_original_cell(i, j) == 'W':
+                pygame.draw.circle(self._static, self._wall, self._grid[i, j],
+                                   10, 0)
 
-        if not training:
-            # Draw each element in the grid
-            for i in range(-1, self.env.rows + 1):
-                for j in range(-1, self.env.cols + 1):
-                    cell = self.env.get_original_cell(i, j)
-                    if (cell == 'W'):
-                        pygame.draw.circle(self.screen, self._wall,
-                                           self._grid[i, j], 10, 0)
-                    elif (cell == 'F'):
-                        if (i, j) in steps:
-                            pygame.draw.circle(self.screen, self._eaten_food,
-                                               self._grid[i, j], 10, 0)
-                        else:
-                            pygame.draw.circle(self.screen, self._food,
-                                               self._grid[i, j], 10, 0)
-                    elif (cell == 'P'):
-                        if (i, j) in steps:
-                            pygame.draw.circle(self.screen, self._eaten_poison,
-                                               self._grid[i, j], 10, 0)
-                        else:
-                            pygame.draw.circle(self.screen, self._poison,
-                                               self._grid[i, j], 10, 0)
-
-            agent = self._grid[steps[-1]]
-            pygame.draw.circle(self.screen, self._agent, agent, 10, 0)
-
-            trace = self._points_to_coordinates(steps)
-            if (len(trace) > 1):
-                pygame.draw.lines(self.screen, self._agent, False, trace, 5)
-
-        # If we have a greedy agent, stop here
         if self._only_grid:
-            pygame.display.update()
             return
 
-        # Draw brain
-        last = self._step >= len(self.agent.output_story)
+        # Render the labels of the neurons
         for i in range(len(self.agent.neurons)):
-            # Render input neuron text
             neuron = self._font.render(self._input_meanings[i],
                                        True, self._black)
             origin = (self._input_o[0],
                       self._input_o[1] + i * self._input_spacing)
-            self.screen.blit(neuron, origin)
-
-            # Render the current neural perception
-            triggered = False
-            if not last:
-                triggered = self.agent.neuron_story[self._step-1][i]
-            if triggered and not training:
-                origin = (self._input_n_o[0],
-                          self._input_n_o[1] + i * self._input_spacing)
-                pygame.draw.circle(self.screen, self._neuron_on,
-                                   origin, 10, 0)
-
-        output = -1
-        if not last:
-            output = self.agent.output_story[self._step-1]
-        for i in range(len(self.agent.outputs)):
-            # Render output neuron text
+            self._static.blit(neuron, origin)
+
+        for i in range(len(self._outputs)):
             neuron = self._font.render(self._output_meanings[i],
                                        True, self._black)
             origin = (self._output_o[0],
                       self._output_o[1] + i * self._output_spacing)
-            self.screen.blit(neuron, origin)
+            self._static.blit(neuron, origin)
+
+    def _build_cells(self):
+        """Render every food and poison cell as seen in the current step"""
+        self._cells = self._static.copy()
+        self._visited = Counter(self.agent.steps[:self._step])
+        for i, j in self._grid:
+            self._draw_cell(i, j, self._visited[i, j] > 0)
+        self._drawn_step = self._step
+
+    def _draw_cell(self, i, j, eaten):
+        """Draw a single food or poison cell in the cells layer"""
+        cell = self.env.get_original_cell(i, j)
+        if (cell == 'F'):
+            color = self._eaten_food if eaten else self._food
+        elif (cell == 'P'):
+            color = self._eaten_poison if eaten else self._poison
+        else:
+            return
+        pygame.draw.circle(self._cells, color, self._grid[i, j], 10, 0)
+
+    def _update_cells(self):
+        """Redraw the cells that changed since the last step drawn
+
+        Moving a step forwards or backwards only adds or removes a single
+        visit to a position, so the visits are counted incrementally and only
+        the cell of that position is redrawn.
+        """
+        while self._drawn_step < self._step:
+            i, j = self.agent.steps[self._drawn_step]
+            self._visited[i, j] += 1
+            self._drawn_step += 1
+            self._draw_cell(i, j, True)
+        while self._drawn_step > self._step:
+            self._drawn_step -= 1
+            i, j = self.agent.steps[self._drawn_step]
+            self._visited[i, j] -= 1
+            self._draw_cell(i, j, self._visited[i, j] > 0)
+
+    def _draw_board(self):
+        """Draw the cells layer, the agent and its trace in the screen"""
+        self.screen.blit(self._cells, self._grid_rect, self._grid_rect)
+        steps = self.agent.steps[:self._step]
+
+        agent = self._grid[steps[-1]]
+        pygame.draw.circle(self.screen, self._agent, agent, 10, 0)
 
-            if i == output and not training and not last:
-                origin = (self._output_n_o[0],
-                          self._output_n_o[1] + i * self._output_spacing)
-                pygame.draw.circle(self.screen, self._neuron_on,
-                                   origin, 10, 0)
+        trace = self._points_to_coordinates(steps)
+        if (len(trace) > 1):
+            pygame.draw.lines(self.screen, self._agent, False, trace, 5)
+
+    def _build_synapses(self, weights):
+        """Render the synapses of the given weights in their own layer"""
+        self._synapses = pygame.Surface(self.screen.get_size(),
+                                        pygame.SRCALPHA)
+        self._synapse_weights = weights.copy()
 
         # Normalize weights to print the lines accordingly
-        max_v = max(self.agent.weights.values())
-        min_v = min(self.agent.weights.values())
+        max_v = weights.max()
+        min_v = weights.min()
         bound = max_v if (max_v > abs(min_v)) else -min_v
-        factor = 255.0 / bound
-        normalized_weights = {k: round(v*factor) for k, v in
-                              self.agent.weights.items()}
+        factor = 255.0 / bound if bound > 0 else 0
+        normalized_weights = (weights * factor).round()
 
-        for i in range(len(self.agent.outputs)):
-            for j in range(len(self.agent.neurons)):
-                weight = round(normalized_weights[i, j])
+        for i in range(len(self._outputs)):
+            for j in range(len(self._inputs)):
+                weight = int(normalized_weights[i, j])
                 if weight > 0:
                     color = (255 - weight, 255, 255 - weight)
                 else:
                     color = (255, 255 + weight, 255 + weight)
                 start = self._inputs[j]
                 end = self._outputs[i]
-                pygame.draw.lines(self.screen, color, False,
+                pygame.draw.lines(self._synapses, color, False,
                                   [start, end], 4)
 
+    def _neuron_states(self, training):
+        """Return the neurons triggered in the current step
+
+        The result is a pair with a tuple of the input neurons triggered and
+        the output neuron chosen (-1 if none).
+        """
+        # The stories are not read while training, since the training thread
+        # is rewriting them
+        if training or self._step >= len(self.agent.output_story):
+            return (), -1
+        neurons = self.agent.neuron_story[self._step-1]
+        triggered = tuple(i for i in range(len(neurons)) if neurons[i])
+        return triggered, self.agent.output_story[self._step-1]
+
+    def _draw_neurons(self, origins, triggered, output):
+        """Redraw the area of some neurons and the synapses over them
+
+        Since neurons can be closer to each other than their size, any
+        triggered neuron overlapping that area is drawn again too. Returns
+        the rectangles of the area redrawn.
+        """
+        areas = [pygame.Rect(x - 10, y - 10, 21, 21) for x, y in origins]
+        on = [self._inputs[i] for i in triggered]
+        if output >= 0:
+            on.append(self._outputs[output])
+        for area in areas:
+            self.screen.set_clip(area)
+            self.screen.blit(self._static, area, area)
+            for x, y in on:
+                if area.colliderect((x - 10, y - 10, 21, 21)):
+                    pygame.draw.circle(self.screen, self._neuron_on, (x, y),
+                                       10, 0)
+            self.screen.blit(self._synapses, area, area)
+        self.screen.set_clip(None)
+        return areas
+
+    def _draw_window(self, training=False):
+        """Draws all the components in the window at a given time"""
+        if self._static is None:
+            self._build_static()
+        self.screen.blit(self._static, (0, 0))
+
+        if not training:
+            self._build_cells()
+            self._draw_board()
+
+        # If we have a greedy agent, stop here
+        if self._only_grid:
+            pygame.display.update()
+            return
+
+        # Draw brain
+        triggered, output = self._neuron_states(training)
+        for i in triggered:
+            pygame.draw.circle(self.screen, self._neuron_on, self._inputs[i],
+                               10, 0)
+        if output >= 0:
+            pygame.draw.circle(self.screen, self._neuron_on,
+                               self._outputs[output], 10, 0)
+        self._drawn_neurons = (triggered, output)
+
+        # Rebuild the synapses only if the weights changed, using the last
+        # snapshot of the weights while training
+        weights = self.agent.weights if self._weights is None else \
+            self._weights
+        if self._synapse_weights is None or \
+                not (weights == self._synapse_weights).all():
+            self._build_synapses(weights)
+        self.screen.blit(self._synapses, (0, 0))
+
         # Display rewards if any
         if self._avg is not None:
-            label = self._font.render('Average rewards: {}'.format(self._avg),
-                                      True, self._black)
+            text = 'Average rewards: {}'.format(self._avg)
+            if training and not self._resume.is_set():
+                text += ' (paused)'
+            label = self._font.render(text, True, self._black)
             self.screen.blit(label, self._avg_o)
 
         # Refresh the window once all the changes are done
         pygame.display.update()
 
+    def _draw_step(self):
+        """Draws only the parts of the window changed by a new step"""
+        self._update_cells()
+        self._draw_board()
+        dirty = [self._grid_rect]
+
+        if not self._only_grid:
+            # Redraw the neurons toggled since the last frame
+            triggered, output = self._neuron_states(False)
+            old_triggered, old_output = self._drawn_neurons
+            toggled = set(triggered).symmetric_difference(old_triggered)
+            origins = [self._inputs[i] for i in toggled]
+            if output != old_output:
+                origins += [self._outputs[i] for i in (old_output, output)
+                            if i >= 0]
+            dirty += self._draw_neurons(origins, triggered, output)
+            self._drawn_neurons = (triggered, output)
+
+        pygame.display.update(dirty)
+
     def next_step(self):
         """Displays next step in the simulation (if any)"""
         if (self._step < len(self.agent.steps)):
             self._step += 1
-            self._draw_window()
+            self._draw_step()
 
     def previous_step(self):
         """Displays previous step in the simulation (if any)"""
         if (self._step > 1):
             self._step -= 1
-            self._draw_window()
+            self._draw_step()
 
     def run(self):
         """Run the complete execution automatically"""
         self._step = 1
-        for step in (self.agent.steps):
-            pygame.time.wait(200)
+        self._draw_window()
+        self._playing = True
+        self._next_play = pygame.time.get_ticks() + self._autoplay_delay
+
+    def _poll_autoplay(self):
+        """Advance the automatic execution when its next step is due"""
+        if not self._playing or pygame.time.get_ticks() < self._next_play:
+            return
+        self._next_play += self._autoplay_delay
+        if self._step < len(self.agent.steps):
             self.next_step()
+        else:
+            self._playing = False
 
     def visual_training(self):
-        """Display the evolution of the ANN during a training"""
-        self._draw_window()
-        for i in range(50):
-            episode_rewards = []
-            for _ in range(100):
-                env = Flatland(10, 10)
-                self.agent.new_environment(env)
-                result = self.agent.learn(50, False)
-                episode_rewards.append(result)
-            self._avg = sum(episode_rewards)/100
+        """Display the evolution of the ANN during a training
+
+        The training runs in a background thread, and the window is redrawn
+        each time the thread publishes the snapshot of a finished episode.
+        """
+        self._playing = False
+        self._weights = self.agent.weights.copy()
+        self._draw_window(training=True)
+        self._cancel.clear()
+        self._resume.set()
+        self._training = threading.Thread(target=self._train, daemon=True)
+        self._training.start()
+
+    def _train(self):
+        """Train the agent, publishing a snapshot after each episode"""
+        # The training games are not displayed, so do not record them
+        record = self.agent.record
+        self.agent.record = False
+        try:
+            for i in range(self._training_episodes):
+                episode_rewards = []
+                for _ in range(100):
+                    self._resume.wait()
+                    if self._cancel.is_set():
+                        return
+                    env = self._next_board()
+                    self.agent.new_environment(env)
+                    result = self.agent.learn(50, False)
+                    episode_rewards.append(result)
+                avg = sum(episode_rewards)/100
+                self._snapshots.put((self.agent.weights.copy(), avg))
+        finally:
+            self.agent.record = record
+            self._snapshots.put(None)
+
+    def _poll_training(self):
+        """Draw the snapshots published by the training thread, if any"""
+        if self._training is None:
+            return
+        snapshot = False
+        try:
+            while True:
+                snapshot = self._snapshots.get_nowait()
+                if snapshot is None:
+                    break
+                self._weights, self._avg = snapshot
+        except queue.Empty:
+            pass
+
+        if snapshot is None:
+            # The training finished or was cancelled: show a new game, unless
+            # the window is being closed
+            self._training.join()
+            self._training = None
+            self._weights = None
+            if not self._end:
+                self._new_run()
+        elif snapshot:
             self._draw_window(training=True)
 
+    def _toggle_pause(self):
+        """Pause the training if it is running, or resume it otherwise"""
+        if self._resume.is_set():
+            self._resume.clear()
+        else:
+            self._resume.set()
+        self._draw_window(training=True)
+
+    def _stop_training(self):
+        """Cancel the training, if any, and wait for its thread to finish"""
+        if self._training is None:
+            return
+        self._cancel.set()
+        self._resume.set()
+        self._training.join()
+
     def _new_run(self):
         """Set a new environment for the agent in the visual mode"""
-        self.env = Flatland(10, 10)
+        self.env = self._next_board()
         # agent.train(20, False)
         self.agent.new_environment(self.env)
-        if isinstance(self.agent, GreedyAgent):
+        # Agents that do not learn, as the GreedyAgent, just play the game
+        if hasattr(self.agent, 'learn'):
+            self.agent.learn(50, False)
+        else:
             self.agent.run(50, False)
+        self._step = 1
+        self._fit_view()
+        self._draw_window()
+
+    def _fit_view(self):
+        """Lay the window out again if the region of the board shown changed
+
+        Lazy boards only show the region of the cells touched in each game,
+        which changes from one game to the next.
+        """
+        if self.env.region() == self._view:
+            return
+        size = (self.width, self.height)
+        self._layout()
+        if (self.width, self.height) != size:
+            self.screen = pygame.display.set_mode((self.width, self.height))
+
+    def _open_replay(self, index):
+        """Show the game of the trajectory file with the given index"""
+        if not 0 <= index < len(self._replays):
+            return
+        self._playing = False
+        self._replay_index = index
+        replay = self._replays[index]
+        resize = (replay.environment.rows, replay.environment.cols,
+                  len(replay.neurons)) != \
+            (self.env.rows, self.env.cols, len(self.agent.neurons))
+        self.agent = replay
+        self.env = replay.environment
+        if resize:
+            self._layout()
+            self.screen = pygame.display.set_mode((self.width, self.height))
         else:
-            self.agent.learn(50, False)
+            # The board changed, but the grid and labels did not
+            self._synapse_weights = None
+        self._set_caption()
         self._step = 1
         self._draw_window()
+
+    def _next_board(self):
+        """Return the board for the next game"""
+        if self._boards is None:
+            return type(self.env)(self.env.rows, self.env.cols)
+        return next(self._boards)